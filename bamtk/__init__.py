@@ -0,0 +1,2 @@
+
+from bamtk.counter import FeatureCounter
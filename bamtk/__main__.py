@@ -17,15 +17,19 @@
 
 import os
 import sys
+import logging
 
 import argparse
 import inspect
 
+from functools import lru_cache
+
 from biolib.common import make_sure_path_exists
 from biolib.logger import logger_setup
 from biolib.misc.custom_help_formatter import CustomHelpFormatter
 
 from bamtk.main import OptionsParser
+from bamtk.server import default_socket, serve, submit
 
 def print_help():
     """Help function"""
@@ -38,6 +42,14 @@ def print_help():
         mm_features             -> making bam features matrix 
         mm_annotated_features   -> making annoted features abundance matrix 
         mm_wf                   -> making bam features and annoted features abundance matrix 
+        mm_merge                -> making bam features matrix from mm_features --shard runs
+
+    Matrix access:
+        query                   -> print selected rows and samples of a matrix
+
+    Server:
+        serve                   -> run jobs sent on a Unix socket, keeping indexes in memory
+        submit                  -> send a job to a running server
 
 
 Use: bamtk <command> -h for command specific help. 
@@ -47,13 +59,27 @@ or posted on GitHub (https://github.com/meb-team/Tools/).
     ''')
 
 
+@lru_cache(maxsize=None)
 def version():
     import bamtk
     versionFile = open(os.path.join(bamtk.__path__[0], 'VERSION'))
     return versionFile.readline().strip()
 
 
-def main():
+def shard(value):
+    """Parse a --shard I/N value"""
+
+    try:
+        i, n = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a I/N shard" % value)
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("shard %s: I must be between 1 and N" % value)
+    return (i, n)
+
+
+def get_parser():
+    """bamtk command line parser"""
 
     # initialize the option parser
     parser = argparse.ArgumentParser(add_help=False,
@@ -74,19 +100,36 @@ def main():
     mm_featuresinput_argument = mm_featuresparser.add_argument_group('optional input arguments')
     mm_featuresinput_argument.add_argument('-x','--extension', help='bam file prefix',default='bam')
     mm_featuresinput_argument.add_argument('-fx','--faidx_extension', help='faidx file prefix',default='fasta.fai')
-    mm_featuresinput_argument.add_argument('-t','--threads', help='threads number for "samtools view"',default='2')
+    mm_featuresinput_argument.add_argument('-t','--threads', help='threads number for "samtools view", or for BAM blocks inflation',default='2')
+    mm_featuresinput_argument.add_argument('-j','--jobs',help='number of alignment files counted in parallel [1]',default=1,type=int)
+    mm_featuresinput_argument.add_argument('--samtools',help='read alignment files through "samtools view" instead of the built-in BAM reader',action='store_true')
+    mm_featuresinput_argument.add_argument('--by_read_group',help='count each @RG read group of the alignment files in its own column named after its SM, or ID, tag; read groups sharing a name are summed in one column, also across alignment files',action='store_true')
+    mm_featuresinput_argument.add_argument('--read_group_library_size',help='tabular file with the library size of each read group column, for --by_read_group',metavar='FILE')
+    mm_featuresinput_argument.add_argument('--fast_index',help='count the mapped reads of each reference from the BAI indexes only, without reading alignments: --mapQ and --id_cutoff are not applied and base matrices are not written',action='store_true')
+    mm_featuresinput_argument.add_argument('--cache',help='keep per-sample counts in the output directory and only count new or modified alignment files',action='store_true')
     mm_featuresinput_argument.add_argument('-Q','--mapQ',help='only include reads with mapping quality >= INT [10]',default='10')
     mm_featuresinput_argument.add_argument('-i','--id_cutoff',help='only include reads with identity >= INT [0]',default=0)
     mm_featuresinput_argument.add_argument('-m','--merge',help='merge features abundance by field',action='store_true')
     mm_featuresinput_argument.add_argument('-s','--separator',help='filed separator for -m/--merge argument',default='.')
     mm_featuresinput_argument.add_argument('-g','--genome',help='sum abundance of all features',action='store_true')
+    mm_featuresinput_argument.add_argument('--compile_index',help='compile the features index next to the faidx on first use and reuse it in later runs',action='store_true')
+    mm_featuresinput_argument.add_argument('--features_list',help='only count the features, or merged features, listed in FILE, reading only their records from indexed BAM files; relative abundances and TPM are relative to the listed features',metavar='FILE')
     mm_featuresoutput_argument = mm_featuresparser.add_argument_group('optional output arguments')
     mm_featuresoutput_argument.add_argument('-n','--feature_normalisation',help="get the number of features per X reads [Default: 1000000]",default=1000000,type=int)
     mm_featuresoutput_argument.add_argument('-sn','--feature_size_normalisation',help="get the number of features per X bases [Default: 1000]",default=1000,type=int)
     mm_featuresoutput_argument.add_argument('-f','--discard_feature_length_normalisation',help="discard feature length normalisation for base count abundance output",action='store_true')
     mm_featuresoutput_argument.add_argument('-l','--discard_library_size_normalisation',help="discard library size normalisation for reads and bases count abundance output",action='store_true')
     mm_featuresoutput_argument.add_argument('-lsn','--library_size_normalisation',help="library size normalisation by total number of reads count or by number of aligned reads ",choices=['total','aligned'],default='total')
+    mm_featuresoutput_argument.add_argument('--coverage',help='also write the breadth and mean depth of coverage of the features, computed in the same pass over the alignments',action='store_true')
+    mm_featuresoutput_argument.add_argument('--format',help='write tabular matrices, a single npz store of the features counts or sparse MatrixMarket matrices [tsv]',choices=['tsv','npz','mtx'],default='tsv')
+    mm_featuresoutput_argument.add_argument('--max_memory',help='spill samples counts to disk and write matrices by row blocks using about INT MB',type=int)
+    mm_featuresoutput_argument.add_argument('--sparse',help='keep only non-zero features counts in memory',action='store_true')
+    mm_featuresoutput_argument.add_argument('--precision',help='write floating point values with INT significant digits [shortest exact representation]',type=int)
+    mm_featuresoutput_argument.add_argument('--compress',help='compress tabular and MatrixMarket matrices (zstd requires the zstandard module)',choices=['gzip','zstd'])
+    mm_featuresoutput_argument.add_argument('--shard',help='only count the I-th of every N samples of the bam_list and save their counts for mm_merge',metavar='I/N',type=shard)
     mm_featuresoutput_argument.add_argument('--removed',help="removed features who do not appears in samples (sum of abundance through sample = 0)",action='store_true')
+    mm_featuresparser.add_argument('--profile', help='write cProfile statistics of the run in FILE (main process only)', metavar='FILE')
+    mm_featuresparser.add_argument('--metrics', help='write per stage time and per sample counters of the run in FILE in JSON format', metavar='FILE')
     mm_featuresparser.add_argument('--silent', help='suppress output of logger', action='store_true')
     mm_featuresparser.add_argument('--force_overwrite', help='force overwriting of output directory', action="store_true", default=False)
     mm_featuresparser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
@@ -98,11 +141,16 @@ def main():
     mm_annotated_features_parser.add_argument('features_annotation',help='features annotation file in tabular format')
     mm_annotated_features_parser.add_argument('annotation_description',help='annotation description file in tabular format')
     mm_annotated_features_input_argument = mm_annotated_features_parser.add_argument_group('optional input arguments')
+    mm_annotated_features_input_argument.add_argument('--rollup',help='tabular file mapping the annotations of the previous level to a higher level (child, parent and optional weight), written to level<N>_annotate_* matrices; repeat it for each level',action='append',metavar='MAPPING')
     mm_annotated_features_input_argument.add_argument('--library_size', help="Tabular file with sample library size to produce normalised count matrix")
     mm_annotated_features_output_argument = mm_annotated_features_parser.add_argument_group('optional output arguments')
     mm_annotated_features_output_argument.add_argument('-f','--feature_normalisation',help="get the number of features per X reads [Default: 1000000]",default=1000000,type=int)
-    mm_annotated_features_output_argument.add_argument('--removed',help="removed features who do not appears in samples (sum of abundance through sample = 0)",action='store_true')                                            
+    mm_annotated_features_output_argument.add_argument('--removed',help="removed features who do not appears in samples (sum of abundance through sample = 0)",action='store_true')
+    mm_annotated_features_output_argument.add_argument('--precision',help='write floating point values with INT significant digits [shortest exact representation]',type=int)
+    mm_annotated_features_output_argument.add_argument('--compress',help='compress tabular and MatrixMarket matrices (zstd requires the zstandard module)',choices=['gzip','zstd'])                                            
     
+    mm_annotated_features_parser.add_argument('--profile', help='write cProfile statistics of the run in FILE (main process only)', metavar='FILE')
+    mm_annotated_features_parser.add_argument('--metrics', help='write per stage time and per sample counters of the run in FILE in JSON format', metavar='FILE')
     mm_annotated_features_parser.add_argument('--silent', help='suppress output of logger', action='store_true')
     mm_annotated_features_parser.add_argument('--force_overwrite', help='force overwriting of output directory', action="store_true", default=False)
 
@@ -115,19 +163,95 @@ def main():
     mm_wf_parser.add_argument('annotation_description',help='annotation description file in tabular format')
     mm_wf_parser.add_argument('output_dir',help='directory to write output files')
     mm_wf_input_argument = mm_wf_parser.add_argument_group('optional input arguments')
+    mm_wf_input_argument.add_argument('--rollup',help='tabular file mapping the annotations of the previous level to a higher level (child, parent and optional weight), written to level<N>_annotate_* matrices; repeat it for each level',action='append',metavar='MAPPING')
     mm_wf_input_argument.add_argument('-x','--extension', help='bam file prefix',default='bam')
     mm_wf_input_argument.add_argument('-fx','--faidx_extension', help='faidx file prefix',default='fasta.fai')
-    mm_wf_input_argument.add_argument('-t','--threads', help='threads number for "samtools view"',default='2')
+    mm_wf_input_argument.add_argument('-t','--threads', help='threads number for "samtools view", or for BAM blocks inflation',default='2')
+    mm_wf_input_argument.add_argument('-j','--jobs',help='number of alignment files counted in parallel [1]',default=1,type=int)
+    mm_wf_input_argument.add_argument('--samtools',help='read alignment files through "samtools view" instead of the built-in BAM reader',action='store_true')
+    mm_wf_input_argument.add_argument('--by_read_group',help='count each @RG read group of the alignment files in its own column named after its SM, or ID, tag; read groups sharing a name are summed in one column, also across alignment files',action='store_true')
+    mm_wf_input_argument.add_argument('--read_group_library_size',help='tabular file with the library size of each read group column, for --by_read_group',metavar='FILE')
+    mm_wf_input_argument.add_argument('--fast_index',help='count the mapped reads of each reference from the BAI indexes only, without reading alignments: --mapQ and --id_cutoff are not applied and base matrices are not written',action='store_true')
+    mm_wf_input_argument.add_argument('--cache',help='keep per-sample counts in the output directory and only count new or modified alignment files',action='store_true')
     mm_wf_input_argument.add_argument('-Q','--mapQ',help='only include reads with mapping quality >= INT [10]',default='10')
     mm_wf_input_argument.add_argument('-i','--id_cutoff',help='only include reads with identity >= INT [0]',default=0)
+    mm_wf_input_argument.add_argument('-m','--merge',help='merge features abundance by field',action='store_true')
+    mm_wf_input_argument.add_argument('-s','--separator',help='filed separator for -m/--merge argument',default='.')
+    mm_wf_input_argument.add_argument('--genome',help='sum abundance of all features',action='store_true')
+    mm_wf_input_argument.add_argument('--compile_index',help='compile the features index next to the faidx on first use and reuse it in later runs',action='store_true')
+    mm_wf_input_argument.add_argument('--features_list',help='only count the features, or merged features, listed in FILE, reading only their records from indexed BAM files; relative abundances and TPM are relative to the listed features',metavar='FILE')
     mm_wf_output_argument = mm_wf_parser.add_argument_group('optional output arguments')
     mm_wf_output_argument.add_argument('-f','--feature_normalisation',help="get the number of features per X reads [Default: 1000000]",default=1000000,type=int)
-    mm_wf_output_argument.add_argument('-g','--discard_gene_length_normalisation',help="discard gene length normalisation for base count abundance output",action='store_true')
+    mm_wf_output_argument.add_argument('-sn','--feature_size_normalisation',help="get the number of features per X bases [Default: 1000]",default=1000,type=int)
+    mm_wf_output_argument.add_argument('-g','--discard_gene_length_normalisation',help="discard gene length normalisation for base count abundance output",action='store_true',dest='discard_feature_length_normalisation')
+    mm_wf_output_argument.add_argument('-l','--discard_library_size_normalisation',help="discard library size normalisation for reads and bases count abundance output",action='store_true')
+    mm_wf_output_argument.add_argument('-lsn','--library_size_normalisation',help="library size normalisation by total number of reads count or by number of aligned reads ",choices=['total','aligned'],default='total')
+    mm_wf_output_argument.add_argument('--no_feature_matrices',help="do not write the features matrices, only the annotated ones",action='store_true')
+    mm_wf_output_argument.add_argument('--coverage',help='also write the breadth and mean depth of coverage of the features, computed in the same pass over the alignments',action='store_true')
+    mm_wf_output_argument.add_argument('--format',help='write tabular matrices, a single npz store of the features counts or sparse MatrixMarket matrices [tsv]',choices=['tsv','npz','mtx'],default='tsv')
+    mm_wf_output_argument.add_argument('--max_memory',help='spill samples counts to disk and write matrices by row blocks using about INT MB',type=int)
+    mm_wf_output_argument.add_argument('--sparse',help='keep only non-zero features counts in memory',action='store_true')
+    mm_wf_output_argument.add_argument('--precision',help='write floating point values with INT significant digits [shortest exact representation]',type=int)
+    mm_wf_output_argument.add_argument('--compress',help='compress tabular and MatrixMarket matrices (zstd requires the zstandard module)',choices=['gzip','zstd'])
     mm_wf_output_argument.add_argument('--removed',help="removed features who do not appears in samples (sum of abundance through sample = 0)",action='store_true')
+    mm_wf_parser.add_argument('--profile', help='write cProfile statistics of the run in FILE (main process only)', metavar='FILE')
+    mm_wf_parser.add_argument('--metrics', help='write per stage time and per sample counters of the run in FILE in JSON format', metavar='FILE')
     mm_wf_parser.add_argument('--silent', help='suppress output of logger', action='store_true')
     mm_wf_parser.add_argument('--force_overwrite', help='force overwriting of output directory', action="store_true", default=False)
     mm_wf_parser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
 
+    mm_merge_parser = subparsers.add_parser('mm_merge',
+                                            description='Merge the stores of mm_features --shard runs into features matrices',
+                                            epilog='bamtk mm_merge ./output ./shard_1/features_shard_1_of_2.npz ./shard_2/features_shard_2_of_2.npz')
+    mm_merge_parser.add_argument('output_dir',help='directory to write output files')
+    mm_merge_parser.add_argument('shard_stores',help='features_shard_I_of_N.npz stores of every shard',nargs='+')
+    mm_merge_output_argument = mm_merge_parser.add_argument_group('optional output arguments')
+    mm_merge_output_argument.add_argument('--format',help='write tabular matrices, a single npz store of the features counts or sparse MatrixMarket matrices [tsv]',choices=['tsv','npz','mtx'],default='tsv')
+    mm_merge_output_argument.add_argument('--max_memory',help='spill samples counts to disk and write matrices by row blocks using about INT MB',type=int)
+    mm_merge_output_argument.add_argument('--sparse',help='keep only non-zero features counts in memory',action='store_true')
+    mm_merge_output_argument.add_argument('--precision',help='write floating point values with INT significant digits [shortest exact representation]',type=int)
+    mm_merge_output_argument.add_argument('--compress',help='compress tabular and MatrixMarket matrices (zstd requires the zstandard module)',choices=['gzip','zstd'])
+    mm_merge_output_argument.add_argument('--removed',help="removed features who do not appears in samples (sum of abundance through sample = 0)",action='store_true')
+    mm_merge_parser.add_argument('--profile', help='write cProfile statistics of the run in FILE (main process only)', metavar='FILE')
+    mm_merge_parser.add_argument('--metrics', help='write per stage time and per sample counters of the run in FILE in JSON format', metavar='FILE')
+    mm_merge_parser.add_argument('--silent', help='suppress output of logger', action='store_true')
+    mm_merge_parser.add_argument('--force_overwrite', help='force overwriting of output directory', action="store_true", default=False)
+    mm_merge_parser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
+
+    query_parser = subparsers.add_parser('query',
+                                         description='Print selected rows and samples of a tabular matrix, seeking to the rows with its .rows.npz index when present',
+                                         epilog='bamtk query ./output/annotate_reads_raw_abundance.tsv -r K00001 K00002 -s sample1')
+    query_parser.add_argument('matrix',help='features or annotation matrix in tabular format')
+    query_parser.add_argument('-r','--rows',help='features or annotations to print [all]',nargs='+',metavar='NAME')
+    query_parser.add_argument('--rows_file',help='file with one feature or annotation per line to print')
+    query_parser.add_argument('-s','--samples',help='samples to print [all]',nargs='+',metavar='NAME')
+    query_parser.add_argument('--samples_file',help='file with one sample per line to print')
+    query_parser.add_argument('-o','--output',help='write the rows in FILE instead of the standard output',metavar='FILE')
+    query_parser.add_argument('--silent', help='suppress warnings', action='store_true')
+    query_parser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
+
+    # persistent worker
+    serve_parser = subparsers.add_parser('serve',
+                                        description='Run mm_features, mm_annotated_features, mm_wf and mm_merge jobs sent on a Unix socket, keeping reference and annotation indexes in memory between jobs')
+    serve_parser.add_argument('--socket',help='Unix socket path [%s]' % default_socket(),default=default_socket())
+    serve_parser.add_argument('--cache_size',help='number of reference and annotation indexes kept in memory [8]',type=int,default=8)
+    serve_parser.add_argument('--silent', help='suppress output of logger', action='store_true')
+    serve_parser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
+
+    submit_parser = subparsers.add_parser('submit',
+                                        description='Send a job to a bamtk server and wait for it to finish')
+    submit_parser.add_argument('--socket',help='Unix socket path [%s]' % default_socket(),default=default_socket())
+    submit_parser.add_argument('--stop',help='stop the server',action='store_true')
+    submit_parser.add_argument('job',help='bamtk command and its arguments, e.g. mm_features toy.fa.fai bamlist.txt results',nargs=argparse.REMAINDER)
+    submit_parser.add_argument('--version',help='print version and exit',action='version',version='bamtk '+ version())
+
+    return parser
+
+
+def main():
+
+    parser = get_parser()
+
     # get and check options
     args = None
     if(len(sys.argv) == 1 or sys.argv[1] == '-h' or sys.argv == '--help'):
@@ -136,16 +260,37 @@ def main():
     else:
         args = parser.parse_args()
 
+    if args.subparser_name == 'submit':
+        if not args.stop and not args.job:
+            parser.error('submit: a bamtk command is required')
+        response = submit(args.socket, args.job, args.stop)
+        if response['error']:
+            print(response['error'], file=sys.stderr)
+        sys.exit(response['status'])
+
+    if args.subparser_name == 'query':
+        # rows are printed on the standard output, log on the standard error
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setLevel(logging.ERROR if args.silent else logging.WARNING)
+        handler.setFormatter(logging.Formatter(fmt="[%(asctime)s] %(levelname)s: %(message)s",
+                                               datefmt="%Y-%m-%d %H:%M:%S"))
+        logging.getLogger('timestamp').addHandler(handler)
+        sys.exit(OptionsParser().parse_options(args))
+
     try:
         logger_setup(args.output_dir, "bamtk.log", "bamtk", version(), args.silent)
     except:
         logger_setup(None, "bamtk.log", "bamtk", version(), args.silent)
 
+    if args.subparser_name == 'serve':
+        serve(args.socket, parser, args.cache_size)
+        return
+
     try:
         parser = OptionsParser()
-        if(False):
+        if args.profile:
             import cProfile
-            cProfile.run('parser.parse_options(args)')
+            cProfile.runctx('parser.parse_options(args)', globals(), locals(), args.profile)
         else:
             parser.parse_options(args)
     except SystemExit:
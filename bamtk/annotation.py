@@ -0,0 +1,211 @@
+#########################################################################################
+#                                                                                       #
+#   annotation.py - features annotation index                                           #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import logging
+
+import numpy as np
+
+HYPOTHETICAL_PROTEIN = 'hypothetical protein'
+
+
+class AnnotationIndex():
+    """Integer index of the annotations described in an annotation file.
+
+    Annotations keep the order of the description file and are followed
+    by the 'hypothetical protein' annotation.
+    """
+
+    def __init__(self, features_annotation, annotation_description):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.annotation_description = annotation_description
+
+        self.features2annotation = {}
+        with open(features_annotation) as f:
+            for line in f:
+                line_list = line.rstrip().split('\t')
+                self.features2annotation[line_list[0]] = line_list[1]
+
+        self.names = []
+        self.descriptions = {}
+        self.ids = {}
+        with open(annotation_description) as f:
+            for line in f:
+                annotation_id, description = line.rstrip().split('\t')
+                self._add(annotation_id, description)
+        self._add(HYPOTHETICAL_PROTEIN, HYPOTHETICAL_PROTEIN)
+
+        self._table_features = None
+        self._table = None
+        self._table_missing = []
+        self._table_unannotated = 0
+        self._warned = False
+
+    def __len__(self):
+        return len(self.names)
+
+    def _add(self, annotation_id, description):
+        if annotation_id not in self.ids:
+            self.ids[annotation_id] = len(self.names)
+            self.names.append(annotation_id)
+        self.descriptions[annotation_id] = description
+
+    def reset_warnings(self):
+        """Report missing annotations again, e.g. for a new job reusing the index"""
+        self._warned = False
+
+    def feature_table(self, features):
+        """Annotation index of each feature, -1 when it cannot be aggregated.
+
+        Features without annotation or annotated with an id absent from
+        the description file are reported once and left out.
+        """
+
+        if not (self._table_features is features or self._table_features == features):
+            table = np.full(len(features), -1, dtype=np.int64)
+            missing = {}
+            unannotated = 0
+            for i, feature in enumerate(features):
+                annotation_id = self.features2annotation.get(feature)
+                if annotation_id is None:
+                    unannotated += 1
+                    continue
+                annotation_index = self.ids.get(annotation_id)
+                if annotation_index is None:
+                    missing[annotation_id] = None
+                    continue
+                table[i] = annotation_index
+
+            self._table_features = features
+            self._table = table
+            self._table_missing = list(missing)
+            self._table_unannotated = unannotated
+            self._warned = False
+
+        if not self._warned:
+            for annotation_id in self._table_missing:
+                self.logger.warning("'%s' not present in %s" % (annotation_id, self.annotation_description))
+            if self._table_unannotated:
+                self.logger.warning('%s features without annotation' % self._table_unannotated)
+            self._warned = True
+        return self._table
+
+    def aggregate(self, features, values, rows=slice(None)):
+        """Sum a features x samples matrix into an annotations x samples matrix.
+
+        values may hold only the given rows of the features matrix.
+        """
+
+        table = self.feature_table(features)[rows]
+        if hasattr(values, 'cols'):
+            # sparse matrix: a single bincount over (annotation, sample) cells
+            annotations = table[values.rows]
+            known = annotations >= 0
+            cells = annotations[known] * values.shape[1] + values.cols[known]
+            counts = np.bincount(cells, weights=values.data[known], minlength=len(self.names) * values.shape[1])
+            return counts.reshape(len(self.names), values.shape[1])
+
+        known = table >= 0
+        table = table[known]
+        values = np.asarray(values)
+        counts = np.zeros((len(self.names), values.shape[1]))
+        for j in range(values.shape[1]):
+            counts[:, j] = np.bincount(table, weights=values[known, j], minlength=len(self.names))
+        return counts
+
+
+class RollupIndex():
+    """Weighted mapping of the annotations of a level to a higher level.
+
+    Each line of the mapping file is a child id, a parent id and an
+    optional weight [1], a child being split between several parents by
+    fractional weights. Parents keep their order of first appearance.
+    """
+
+    def __init__(self, mapping, children):
+        """Initialization.
+
+        children are the annotation ids of the previous level, in the
+        order of its rows.
+        """
+        self.logger = logging.getLogger('timestamp')
+        self.mapping = mapping
+
+        child_rows = {child: i for i, child in enumerate(children)}
+        self.names = []
+        ids = {}
+        rows = []
+        parents = []
+        weights = []
+        missing = set()
+        with open(mapping) as f:
+            for number, line in enumerate(f, 1):
+                line_list = line.rstrip('\n').split('\t')
+                if not line.strip():
+                    continue
+                try:
+                    child, parent = line_list[:2]
+                    weight = float(line_list[2]) if len(line_list) > 2 and line_list[2] else 1.0
+                except ValueError:
+                    raise ValueError('%s line %d: expected child id, parent id and optional weight' % (mapping, number))
+                if parent not in ids:
+                    ids[parent] = len(self.names)
+                    self.names.append(parent)
+                if child not in child_rows:
+                    missing.add(child)
+                    continue
+                rows.append(child_rows[child])
+                parents.append(ids[parent])
+                weights.append(weight)
+        self._warnings = []
+        if missing:
+            self._warnings.append('%d ids of %s not present in the previous level' % (len(missing), mapping))
+        unmapped = len(children) - len(set(rows))
+        if unmapped:
+            self._warnings.append('%d annotations without parent in %s' % (unmapped, mapping))
+        self.reset_warnings()
+
+        self.rows = np.array(rows, dtype=np.int64)
+        self.parents = np.array(parents, dtype=np.int64)
+        self.weights = np.array(weights, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def reset_warnings(self):
+        """Report unmapped ids again, e.g. for a new job reusing the index"""
+        self._warned = False
+
+    def aggregate(self, values):
+        """Weighted sum of a children x samples matrix into a parents x samples matrix"""
+
+        if not self._warned:
+            for warning in self._warnings:
+                self.logger.warning(warning)
+            self._warned = True
+
+        values = np.asarray(values)
+        n_samples = values.shape[1]
+        cells = (self.parents[:, None] * n_samples + np.arange(n_samples)).ravel()
+        weighted = (values[self.rows] * self.weights[:, None]).ravel()
+        counts = np.bincount(cells, weights=weighted, minlength=len(self.names) * n_samples)
+        return counts.reshape(len(self.names), n_samples)
@@ -0,0 +1,892 @@
+#########################################################################################
+#                                                                                       #
+#   bam.py - native BGZF/BAM reader                                                     #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import sys
+import logging
+import re
+import struct
+import subprocess
+import time
+import zlib
+
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from bamtk.common import findEx
+from bamtk.coverage import Coverage
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BAM_MAGIC = b'BAM\x01'
+BAI_MAGIC = b'BAI\x01'
+
+# bytes read at once from a "samtools view" pipe
+SAMTOOLS_CHUNK_SIZE = 1 << 22
+
+# distinct CIGAR strings whose lengths are memoized
+CIGAR_CACHE_SIZE = 65536
+
+# blocks inflated ahead of the reader per inflating thread
+BGZF_READ_AHEAD = 4
+
+# bin holding the virtual offsets span and mapped/unmapped counts of a reference
+BAI_PSEUDO_BIN = 37450
+
+# size of the fixed part of an alignment record, block_size included
+RECORD_FIXED_SIZE = 36
+
+# CIGAR operations consuming the query sequence: M, I, S, =, X
+CIGAR_QUERY_OPS = (0, 1, 4, 7, 8)
+
+# CIGAR operations consuming the reference: M, D, N, =, X
+CIGAR_REFERENCE_OPS = (0, 2, 3, 7, 8)
+
+# CIGAR operations covering the reference with read bases: M, =, X
+CIGAR_ALIGNED_OPS = (0, 7, 8)
+
+_INT32 = struct.Struct('<i')
+_UINT16 = struct.Struct('<H')
+_UINT64 = struct.Struct('<Q')
+_CIGAR_RE = re.compile(rb'(\d+)([MIDNSHP=X])')
+
+# value size of the fixed size optional field types, 0 for the others
+_AUX_SIZES = np.zeros(256, dtype=np.int64)
+for _type, _size in ((b'AcC', 1), (b'sS', 2), (b'iIf', 4)):
+    _AUX_SIZES[list(_type)] = _size
+
+
+class BamFormatError(Exception):
+    pass
+
+
+class BgzfReader():
+    """Read and inflate the BGZF blocks of a BAM file.
+
+    With threads > 1, blocks are inflated by a thread pool (zlib releases
+    the GIL) reading ahead of the consumer, and are still yielded in file
+    order.
+    """
+
+    def __init__(self, path, threads=1):
+        """Initialization"""
+        self.path = path
+        self.handle = open(path, 'rb')
+        self.threads = max(1, int(threads))
+        self.read_ahead = BGZF_READ_AHEAD * self.threads
+        self.bytes_read = 0
+        self.bytes_inflated = 0
+        self.inflate_seconds = 0.0
+        self._executor = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.handle.close()
+
+    def seek(self, coffset):
+        self.handle.seek(coffset)
+
+    def blocks(self, stop=None):
+        """Yield the file offset and inflated content of each BGZF block.
+
+        Blocks after the one starting at the stop file offset are only
+        read ahead one at a time, when the consumer asks for them.
+        inflate_seconds is the time spent inflating or waiting for
+        inflated blocks.
+        """
+
+        if self.threads == 1:
+            for coffset, deflated in self._deflated_blocks():
+                start = time.perf_counter()
+                data = zlib.decompress(deflated, -15)
+                self.inflate_seconds += time.perf_counter() - start
+                self.bytes_inflated += len(data)
+                if data:
+                    yield coffset, data
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        pending = deque()
+        deflated_blocks = self._deflated_blocks()
+        exhausted = False
+        read_ahead = self.read_ahead
+        while True:
+            while not exhausted and len(pending) < read_ahead:
+                block = next(deflated_blocks, None)
+                if block is None:
+                    exhausted = True
+                    break
+                coffset, deflated = block
+                pending.append((coffset, self._executor.submit(zlib.decompress, deflated, -15)))
+                if stop is not None and coffset >= stop:
+                    read_ahead = 1
+            if not pending:
+                return
+            start = time.perf_counter()
+            coffset, inflated = pending.popleft()
+            data = inflated.result()
+            self.inflate_seconds += time.perf_counter() - start
+            self.bytes_inflated += len(data)
+            if data:
+                yield coffset, data
+
+    def _deflated_blocks(self):
+        """Yield the file offset and raw deflate stream of each BGZF block"""
+
+        read = self.handle.read
+        while True:
+            coffset = self.handle.tell()
+            header = read(12)
+            if len(header) == 0:
+                return
+            if len(header) < 12 or header[:4] != BGZF_MAGIC:
+                raise BamFormatError('%s is not a BGZF compressed file' % self.path)
+            xlen = _UINT16.unpack_from(header, 10)[0]
+            extra = read(xlen)
+            bsize = None
+            i = 0
+            while i + 4 <= xlen:
+                slen = _UINT16.unpack_from(extra, i + 2)[0]
+                if extra[i:i + 2] == b'BC':
+                    bsize = _UINT16.unpack_from(extra, i + 4)[0]
+                    break
+                i += 4 + slen
+            if bsize is None:
+                raise BamFormatError('Missing BGZF block size in %s' % self.path)
+            rest = read(bsize - xlen - 11)
+            if len(rest) < bsize - xlen - 11:
+                raise BamFormatError('Truncated BGZF block in %s' % self.path)
+            self.bytes_read += 12 + bsize - 11
+            yield coffset, rest[:-8]
+
+
+class AlignmentBatch():
+    """Decoded fields of a batch of alignment records"""
+
+    def __init__(self, ref_id, mapq, flag, read_len, matched, group=None, blocks=None):
+        """Initialization"""
+        self.ref_id = ref_id
+        self.mapq = mapq
+        self.flag = flag
+        self.read_len = read_len
+        self.matched = matched
+        # read group index of each record, -1 without a known RG:Z tag
+        self.group = group
+        # (record, start, end) of the aligned blocks on the reference
+        self.blocks = blocks
+
+    def __len__(self):
+        return len(self.ref_id)
+
+
+class BamReader():
+    """Decode BAM alignment records without going through SAM text"""
+
+    def __init__(self, path, batch_size=1 << 22, threads=1):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.path = path
+        self.batch_size = batch_size
+        self.bgzf = BgzfReader(path, threads)
+        self._blocks = self.bgzf.blocks()
+        self._buffer = b''
+        # uncompressed offsets of the buffer start and of the stop virtual
+        # offset, from the start of the block the reader was moved to
+        self._position = 0
+        self._stop = None
+        self._limit = None
+        self.text = ''
+        self.references = []
+        self.lengths = []
+        self.stats = {'records': 0, 'unplaced': 0, 'mapq_filtered': 0, 'id_filtered': 0, 'counted': 0}
+        self._read_header()
+        self.read_groups = parse_read_groups(self.text)
+
+    def close(self):
+        self.bgzf.close()
+
+    def _fill(self, size, bounded=True):
+        """Make sure at least size bytes are buffered, return False at EOF.
+
+        Once the stop virtual offset is buffered, bounded filling reads no
+        further block.
+        """
+
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while available < size:
+            if bounded and self._limit is not None and self._position + available >= self._limit:
+                break
+            try:
+                coffset, block = next(self._blocks)
+            except StopIteration:
+                break
+            if self._stop is not None and self._limit is None and coffset >= self._stop >> 16:
+                self._limit = self._position + available
+                if coffset == self._stop >> 16:
+                    self._limit += self._stop & 0xffff
+            chunks.append(block)
+            available += len(block)
+        self._buffer = b''.join(chunks)
+        return available >= size
+
+    def seek(self, virtual_offset, stop=None):
+        """Move to a BGZF virtual offset, reading records up to the stop virtual offset.
+
+        Blocks after stop are still read to complete a record starting
+        before it.
+        """
+
+        self.bgzf.seek(virtual_offset >> 16)
+        self._blocks = self.bgzf.blocks(None if stop is None else stop >> 16)
+        self._buffer = b''
+        self._position = 0
+        self._stop = stop
+        self._limit = None
+        self._fill(virtual_offset & 0xffff, False)
+        self._buffer = self._buffer[virtual_offset & 0xffff:]
+        self._position = virtual_offset & 0xffff
+
+    def _take(self, size):
+        if not self._fill(size):
+            raise BamFormatError('Truncated BAM header in %s' % self.path)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self._position += size
+        return data
+
+    def _read_header(self):
+        if self._take(4) != BAM_MAGIC:
+            raise BamFormatError('%s is not a BAM file' % self.path)
+        l_text = _INT32.unpack(self._take(4))[0]
+        self.text = self._take(l_text).rstrip(b'\x00').decode('ascii', 'replace')
+        n_ref = _INT32.unpack(self._take(4))[0]
+        for _ in range(n_ref):
+            l_name = _INT32.unpack(self._take(4))[0]
+            self.references.append(self._take(l_name).rstrip(b'\x00').decode('ascii'))
+            self.lengths.append(_INT32.unpack(self._take(4))[0])
+
+    def _raw_batches(self):
+        """Yield (buffer, record offsets) pairs of complete records"""
+
+        unpack = _INT32.unpack_from
+        while self._fill(self.batch_size) or self._buffer:
+            buf = self._buffer
+            n = len(buf)
+            # records starting at or after the stop virtual offset are left out
+            stop = n if self._limit is None else min(n, self._limit - self._position)
+            offsets = []
+            off = 0
+            while off + 4 <= n and off < stop:
+                end = off + 4 + unpack(buf, off)[0]
+                if end > n:
+                    break
+                offsets.append(off)
+                off = end
+            if self._limit is not None and off >= self._limit - self._position:
+                self._buffer = b''
+                if offsets:
+                    yield buf, np.array(offsets, dtype=np.int64)
+                return
+            if not offsets:
+                if not self._fill(n + 1, False):
+                    raise BamFormatError('Truncated alignment record in %s' % self.path)
+                continue
+            self._buffer = buf[off:]
+            self._position += off
+            yield buf, np.array(offsets, dtype=np.int64)
+
+    def batches(self, min_mapq=0, ref_start=0, ref_stop=None, read_groups=None, blocks=False):
+        """Yield AlignmentBatch of placed records with MAPQ >= min_mapq.
+
+        Only records placed on reference ids in [ref_start, ref_stop) are
+        kept and accounted for in stats when ref_stop is given. With a
+        list of read_groups ids, the group of each record is its index in
+        the list. With blocks, the aligned blocks of the records on the
+        reference are decoded too.
+        """
+
+        for buf, offsets in self._raw_batches():
+            data = np.frombuffer(buf, dtype=np.uint8)
+            ref_id = _gather(data, offsets + 4, '<i4')
+            mapq = data[offsets + 13]
+            placed = ref_id >= 0
+            records = len(offsets)
+            if ref_stop is not None:
+                placed = (ref_id >= ref_start) & (ref_id < ref_stop)
+                records = int(placed.sum())
+            keep = placed & (mapq >= min_mapq)
+            self.stats['records'] += records
+            self.stats['unplaced'] += records - int(placed.sum())
+            self.stats['mapq_filtered'] += int(placed.sum()) - int(keep.sum())
+            offsets = offsets[keep]
+            ref_id = ref_id[keep]
+            mapq = mapq[keep]
+            l_read_name = data[offsets + 12].astype(np.int64)
+            n_cigar = _gather(data, offsets + 16, '<u2').astype(np.int64)
+            flag = _gather(data, offsets + 18, '<u2')
+            l_seq = _gather(data, offsets + 20, '<i4').astype(np.int64)
+
+            # binary CIGAR: one uint32 per operation, length << 4 | op
+            record = np.repeat(np.arange(len(offsets)), n_cigar)
+            first = np.cumsum(n_cigar) - n_cigar
+            cigar_pos = (np.repeat(offsets + RECORD_FIXED_SIZE + l_read_name, n_cigar)
+                         + 4 * (np.arange(len(record)) - np.repeat(first, n_cigar)))
+            cigar = _gather(data, cigar_pos, '<u4')
+            op = cigar & 0xf
+            op_len = (cigar >> 4).astype(np.int64)
+            matched = np.bincount(record, weights=op_len * (op == 0),
+                                  minlength=len(offsets)).astype(np.int64)
+            query_len = np.bincount(record, weights=op_len * np.isin(op, CIGAR_QUERY_OPS),
+                                    minlength=len(offsets)).astype(np.int64)
+            read_len = np.where(l_seq > 0, l_seq, query_len)
+
+            group = None
+            if read_groups is not None:
+                aux_start = offsets + RECORD_FIXED_SIZE + l_read_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq
+                aux_stop = offsets + 4 + _gather(data, offsets, '<i4').astype(np.int64)
+                group = _read_group(data, aux_start, aux_stop, read_groups)
+
+            aligned = None
+            if blocks:
+                # reference offset of each operation from the record position
+                ref_len = op_len * np.isin(op, CIGAR_REFERENCE_OPS)
+                before = np.cumsum(ref_len) - ref_len
+                op_start = (np.repeat(_gather(data, offsets + 8, '<i4').astype(np.int64), n_cigar)
+                            + before - before[np.repeat(first, n_cigar)])
+                block = np.isin(op, CIGAR_ALIGNED_OPS)
+                aligned = (record[block], op_start[block], op_start[block] + op_len[block])
+
+            yield AlignmentBatch(ref_id, mapq, flag, read_len, matched, group, aligned)
+
+    def count(self, min_mapq=0, id_cutoff=0, ref_start=0, ref_stop=None, read_groups=None, coverage=False,
+              coverage_groups=None):
+        """Count reads and matched bases per reference.
+
+        Only records placed on reference ids in [ref_start, ref_stop) are
+        counted. Returns the reference names and two arrays of reads and
+        bases count in the BAM header order. With a list of read_groups
+        ids, the arrays are references x read groups and records of other
+        read groups are not counted. With coverage, arrays of covered
+        bases and summed depth of the counted records follow, read groups
+        mapped to the same one by coverage_groups being covered together.
+        Records and time counters are accumulated in the stats attribute.
+        """
+
+        n_ref = len(self.references)
+        n_groups = 1 if read_groups is None else len(read_groups)
+        covering = Coverage(n_groups, self.lengths, coverage_groups) if coverage else None
+        reads = np.zeros(n_ref * n_groups, dtype=np.int64)
+        bases = np.zeros(n_ref * n_groups, dtype=np.int64)
+        if read_groups is not None:
+            self.stats['no_read_group'] = 0
+        processed = 0
+        decode_seconds = count_seconds = 0.0
+        inflate_seconds = self.bgzf.inflate_seconds
+        start = time.perf_counter()
+        for batch in self.batches(min_mapq, ref_start, ref_stop, read_groups, coverage):
+            fetched = time.perf_counter()
+            decode_seconds += fetched - start
+            identity = np.divide(batch.matched, batch.read_len, out=np.zeros(len(batch)),
+                                 where=batch.read_len > 0)
+            keep = ~(identity < id_cutoff) & (batch.ref_id >= ref_start)
+            self.stats['id_filtered'] += len(batch) - int(keep.sum())
+            cells = batch.ref_id
+            if read_groups is not None:
+                grouped = batch.group >= 0
+                self.stats['no_read_group'] += int((keep & ~grouped).sum())
+                keep &= grouped
+                cells = batch.ref_id * n_groups + batch.group
+            self.stats['counted'] += int(keep.sum())
+            reads += np.bincount(cells[keep], minlength=len(reads))
+            bases += np.bincount(cells[keep], weights=batch.matched[keep],
+                                 minlength=len(bases)).astype(np.int64)
+            if covering is not None:
+                _add_coverage(covering, batch, keep)
+            if (processed + len(batch)) // 1000000 > processed // 1000000:
+                self.logger.info("Alignment record %s processed" % (processed + len(batch)))
+            processed += len(batch)
+            start = time.perf_counter()
+            count_seconds += start - fetched
+        decode_seconds += time.perf_counter() - start
+
+        inflate_seconds = self.bgzf.inflate_seconds - inflate_seconds
+        self.stats['inflate_seconds'] = inflate_seconds
+        self.stats['decode_seconds'] = decode_seconds - inflate_seconds
+        self.stats['count_seconds'] = count_seconds
+        self.stats['bytes_read'] = self.bgzf.bytes_read
+        self.stats['bytes_inflated'] = self.bgzf.bytes_inflated
+        counts = (reads.reshape(n_ref, n_groups), bases.reshape(n_ref, n_groups))
+        if covering is not None:
+            if covering.unsorted:
+                self.logger.warning('%s is not sorted by coordinate, breadth of coverage may be over-estimated' % self.path)
+            counts += covering.arrays(None, n_ref)
+        if read_groups is None:
+            counts = tuple(c.ravel() for c in counts)
+        return (self.references,) + counts
+
+
+class BamIndex():
+    """Virtual offsets span of each reference read from a BAI index.
+
+    mapped and unmapped are the records count of each reference from its
+    pseudo-bin, None for a reference with records but no pseudo-bin.
+    """
+
+    def __init__(self, path):
+        """Initialization"""
+        self.path = path
+        self.spans = []
+        self.mapped = []
+        self.unmapped = []
+        self._read()
+
+    @staticmethod
+    def find(alignment_file):
+        """Return the BAI index path of an alignment file, or None"""
+
+        for path in (alignment_file + '.bai', os.path.splitext(alignment_file)[0] + '.bai'):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data[:4] != BAI_MAGIC:
+            raise BamFormatError('%s is not a BAI index' % self.path)
+        n_ref = _INT32.unpack_from(data, 4)[0]
+        off = 8
+        for _ in range(n_ref):
+            n_bin = _INT32.unpack_from(data, off)[0]
+            off += 4
+            beg = end = None
+            mapped = unmapped = 0
+            pseudo = None
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from('<Ii', data, off)
+                off += 8
+                chunks = struct.unpack_from('<%dQ' % (2 * n_chunk), data, off)
+                off += 16 * n_chunk
+                if bin_id == BAI_PSEUDO_BIN:
+                    pseudo = chunks
+                    continue
+                for chunk_beg in chunks[0::2]:
+                    beg = chunk_beg if beg is None else min(beg, chunk_beg)
+                for chunk_end in chunks[1::2]:
+                    end = chunk_end if end is None else max(end, chunk_end)
+            if pseudo is not None:
+                beg, end, mapped, unmapped = pseudo[:4]
+            n_intv = _INT32.unpack_from(data, off)[0]
+            off += 4 + 8 * n_intv
+            self.spans.append(None if beg is None else (beg, end))
+            if pseudo is None and beg is not None:
+                mapped = unmapped = None
+            self.mapped.append(mapped)
+            self.unmapped.append(unmapped)
+
+    def regions(self, n):
+        """Split references into at most n consecutive ranges of similar size.
+
+        Returns (ref_start, ref_stop, virtual_start, virtual_stop) tuples
+        covering every reference with indexed records.
+        """
+
+        placed = [(i, span) for i, span in enumerate(self.spans) if span is not None]
+        if not placed:
+            return []
+        total = sum((end >> 16) - (beg >> 16) + 1 for _, (beg, end) in placed)
+        target = total / max(1, n)
+
+        regions = []
+        current = []
+        size = 0
+        for i, (beg, end) in placed:
+            current.append((i, beg, end))
+            size += (end >> 16) - (beg >> 16) + 1
+            if size >= target and len(regions) < n - 1:
+                regions.append(current)
+                current = []
+                size = 0
+        if current:
+            regions.append(current)
+
+        return [(r[0][0], r[-1][0] + 1, min(c[1] for c in r), max(c[2] for c in r)) for r in regions]
+
+    def targets(self, ref_ids):
+        """Regions of the indexed records of the given reference ids only.
+
+        Returns (ref_start, ref_stop, virtual_start, virtual_stop) tuples,
+        consecutive references being read as a single region.
+        """
+
+        regions = []
+        for i in sorted(set(int(i) for i in ref_ids)):
+            if i >= len(self.spans) or self.spans[i] is None:
+                continue
+            beg, end = self.spans[i]
+            if regions and regions[-1][1] == i:
+                ref_start, ref_stop, virtual_start, virtual_stop = regions[-1]
+                regions[-1] = (ref_start, i + 1, min(virtual_start, beg), max(virtual_stop, end))
+            else:
+                regions.append((i, i + 1, beg, end))
+        return regions
+
+
+class SamtoolsView():
+    """Count alignment records through a "samtools view" pipe"""
+
+    def __init__(self, path, threads='2'):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.path = path
+        self.threads = threads
+        self.stats = {'records': 0, 'unplaced': 0, 'mapq_filtered': None, 'id_filtered': 0, 'counted': 0}
+        self.samtools = findEx('samtools')
+        if self.samtools is None:
+            self.logger.error('samtools is not on the system path')
+            sys.exit(1)
+
+    def header(self):
+        """SAM header text of the alignment file"""
+
+        return subprocess.check_output([self.samtools, 'view', '-H', self.path]).decode('ascii', 'replace')
+
+    def count(self, min_mapq=0, id_cutoff=0, read_groups=None, coverage=False, coverage_groups=None):
+        """Count reads and matched bases per reference.
+
+        The pipe is read by chunks of SAMTOOLS_CHUNK_SIZE bytes and only
+        the RNAME, POS, CIGAR and SEQ fields of each line are split out,
+        lines being decoded only for their reference names. With a list of
+        read_groups ids and with coverage, counts are the ones returned by
+        BamReader.count().
+        """
+
+        cmd = [self.samtools, 'view', '-@ ' + str(self.threads), '-q ' + str(min_mapq), self.path]
+        reads = {}
+        bases = {}
+        bytes_read = 0
+        records = unplaced = id_filtered = no_read_group = 0
+        cigar_lengths = _cigar_lengths
+        groups = None
+        if read_groups is not None:
+            groups = {group.encode(): g for g, group in enumerate(read_groups)}
+        covering = None
+        if coverage:
+            covering = Coverage(1 if groups is None else len(groups), parse_reference_lengths(self.header()),
+                                coverage_groups)
+        cigar_blocks = _cigar_blocks
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        rest = b''
+        while True:
+            chunk = p.stdout.read(SAMTOOLS_CHUNK_SIZE)
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            processed = records
+            for line in lines:
+                fields = line.split(b'\t', 10)
+                if len(fields) < 10:
+                    continue
+                records += 1
+                reference = fields[2]
+                if reference == b'*':
+                    unplaced += 1
+                    continue
+                base_mapped, query_len = cigar_lengths(fields[5])
+                read_len = len(fields[9]) if fields[9] != b'*' else query_len
+                identity = base_mapped / read_len if read_len > 0 else 0
+                if identity < id_cutoff:
+                    id_filtered += 1
+                    continue
+                group = 0
+                if groups is not None:
+                    tags = fields[10] if len(fields) > 10 else b''
+                    tag = tags.find(b'\tRG:Z:')
+                    group = groups.get(tags[tag + 6:].split(b'\t', 1)[0]) if tag >= 0 else None
+                    if group is None:
+                        no_read_group += 1
+                        continue
+                if covering is not None:
+                    starts, ends = cigar_blocks(fields[5])
+                    position = int(fields[3]) - 1
+                    covering.add(reference, [position + s for s in starts], [position + e for e in ends], group)
+                if groups is not None:
+                    reference = (reference, group)
+                if reference in reads:
+                    reads[reference] += 1
+                    bases[reference] += base_mapped
+                else:
+                    reads[reference] = 1
+                    bases[reference] = base_mapped
+            if records // 1000000 > processed // 1000000:
+                self.logger.info("Alignment record %s processed" % records)
+        if rest.strip():
+            raise BamFormatError('Truncated "samtools view" output for %s' % self.path)
+        p.wait()
+        self.stats['records'] = records
+        self.stats['unplaced'] = unplaced
+        self.stats['id_filtered'] = id_filtered
+        self.stats['counted'] = records - unplaced - id_filtered - no_read_group
+        self.stats['bytes_read'] = bytes_read
+
+        encoding = sys.getdefaultencoding()
+        if groups is not None:
+            self.stats['no_read_group'] = no_read_group
+            references = list(dict.fromkeys(reference for reference, group in reads))
+            positions = {reference: i for i, reference in enumerate(references)}
+            group_reads = np.zeros((len(references), len(groups)), dtype=np.int64)
+            group_bases = np.zeros((len(references), len(groups)), dtype=np.int64)
+            for (reference, group), count in reads.items():
+                group_reads[positions[reference], group] = count
+                group_bases[positions[reference], group] = bases[(reference, group)]
+            counts = (group_reads, group_bases)
+        else:
+            references = list(reads.keys())
+            positions = {reference: i for i, reference in enumerate(references)}
+            counts = (np.array([reads[r] for r in references], dtype=np.int64),
+                      np.array([bases[r] for r in references], dtype=np.int64))
+        if covering is not None:
+            if covering.unsorted:
+                self.logger.warning('%s is not sorted by coordinate, breadth of coverage may be over-estimated' % self.path)
+            coverage_counts = covering.arrays(positions, len(references))
+            if groups is None:
+                coverage_counts = tuple(c.ravel() for c in coverage_counts)
+            counts += coverage_counts
+        return ([r.decode(encoding) for r in references],) + counts
+
+
+@lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def _cigar_lengths(cigar):
+    """Matched (M) and query consuming lengths of a text CIGAR"""
+
+    base_mapped = 0
+    query_len = 0
+    for length, op in _CIGAR_RE.findall(cigar):
+        if op == b'M':
+            base_mapped += int(length)
+        if op in b'MIS=X':
+            query_len += int(length)
+    return base_mapped, query_len
+
+
+@lru_cache(maxsize=CIGAR_CACHE_SIZE)
+def _cigar_blocks(cigar):
+    """Start and end offsets of the aligned blocks of a text CIGAR on the reference"""
+
+    starts = []
+    ends = []
+    offset = 0
+    for length, op in _CIGAR_RE.findall(cigar):
+        if op in b'M=X':
+            starts.append(offset)
+            ends.append(offset + int(length))
+        if op in b'MDN=X':
+            offset += int(length)
+    return starts, ends
+
+
+def _add_coverage(coverage, batch, keep):
+    """Add the aligned blocks of the kept records of a batch, one reference at a time"""
+
+    record, starts, ends = batch.blocks
+    kept = keep[record]
+    record = record[kept]
+    references = batch.ref_id[record]
+    groups = batch.group[record] if batch.group is not None else np.zeros(len(record), dtype=np.int64)
+    starts = starts[kept]
+    ends = ends[kept]
+    bounds = [0] + (np.flatnonzero(np.diff(references)) + 1).tolist() + [len(references)]
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if first < last:
+            coverage.add(int(references[first]), starts[first:last], ends[first:last], groups[first:last])
+
+
+def count_records(records, min_mapq=0, id_cutoff=0):
+    """Count reads and matched bases per reference of alignment records.
+
+    records yields (reference name, mapping quality, CIGAR, read length)
+    tuples, e.g. (r.reference_name, r.mapping_quality, r.cigarstring,
+    r.query_length) for pysam records. Unplaced records have a None or
+    '*' reference and a missing read length is the query length of the
+    CIGAR. Records are filtered as by count_alignments().
+    """
+
+    reads = {}
+    bases = {}
+    for reference, mapq, cigar, read_len in records:
+        if mapq < min_mapq or reference is None or reference == '*':
+            continue
+        if isinstance(cigar, str):
+            cigar = cigar.encode()
+        base_mapped, query_len = _cigar_lengths(cigar or b'')
+        read_len = read_len or query_len
+        identity = base_mapped / read_len if read_len > 0 else 0
+        if identity < id_cutoff:
+            continue
+        if reference in reads:
+            reads[reference] += 1
+            bases[reference] += base_mapped
+        else:
+            reads[reference] = 1
+            bases[reference] = base_mapped
+
+    references = list(reads.keys())
+    return (references,
+            np.array([reads[r] for r in references], dtype=np.int64),
+            np.array([bases[r] for r in references], dtype=np.int64))
+
+
+def count_alignments(alignment_file, min_mapq=0, id_cutoff=0, samtools=False, threads='2', region=None,
+                     with_stats=False, read_groups=None, coverage=False, coverage_groups=None):
+    """Count reads and matched bases per reference of an alignment file.
+
+    region is a (ref_start, ref_stop, virtual_start, virtual_stop) tuple
+    from BamIndex.regions() restricting counting to part of the file.
+    threads is the number of "samtools view" threads, or of BGZF
+    inflating threads when reading the BAM file directly. With with_stats, the records counters, start time and wall and CPU time of the
+    count are returned as the last element. With a list of read_groups
+    ids, counts are references x read groups arrays. With coverage, the
+    covered bases and summed depth arrays follow the reads and bases ones.
+    coverage_groups gives the read group the coverage of each read group
+    is added to, the coverage of read groups sharing a sample being the
+    coverage of their union.
+    """
+
+    started, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    if samtools:
+        reader = SamtoolsView(alignment_file, threads)
+        counts = reader.count(min_mapq, id_cutoff, read_groups, coverage, coverage_groups)
+    else:
+        reader = BamReader(alignment_file, threads=threads)
+        try:
+            if region is None:
+                counts = reader.count(min_mapq, id_cutoff, read_groups=read_groups, coverage=coverage,
+                                      coverage_groups=coverage_groups)
+            else:
+                ref_start, ref_stop, virtual_start, virtual_stop = region
+                reader.seek(virtual_start, virtual_stop)
+                counts = reader.count(min_mapq, id_cutoff, ref_start, ref_stop, read_groups, coverage,
+                                      coverage_groups)
+        finally:
+            reader.close()
+
+    if not with_stats:
+        return counts
+    stats = dict(reader.stats, wall_seconds=time.perf_counter() - wall, cpu_seconds=time.process_time() - cpu,
+                 started=started)
+    return counts + (stats,)
+
+
+def parse_reference_lengths(text):
+    """Length of each @SQ reference of a SAM header, keyed by the encoded reference name"""
+
+    lengths = {}
+    for line in text.splitlines():
+        if not line.startswith('@SQ\t'):
+            continue
+        tags = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+        if 'SN' in tags and 'LN' in tags:
+            lengths[tags['SN'].encode()] = int(tags['LN'])
+    return lengths
+
+
+def parse_read_groups(text):
+    """(ID, sample name) of each @RG line of a SAM header, the sample name being SM or ID"""
+
+    read_groups = []
+    for line in text.splitlines():
+        if not line.startswith('@RG\t'):
+            continue
+        tags = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+        if 'ID' in tags:
+            read_groups.append((tags['ID'], tags.get('SM', tags['ID'])))
+    return read_groups
+
+
+def _aux_tag(data, start, stop, tag, nuls):
+    """Value position of an optional field in [start, stop) of each record, -1 when absent.
+
+    Optional fields of all records are walked together, one field per
+    iteration, NUL terminated values being skipped with a search in nuls,
+    the sorted positions of the NUL bytes of data followed by len(data).
+    """
+
+    found = np.full(len(start), -1, dtype=np.int64)
+    position = start.copy()
+    active = np.flatnonzero(position + 3 <= stop)
+    while len(active):
+        p = position[active]
+        hit = (data[p] == tag[0]) & (data[p + 1] == tag[1])
+        found[active[hit]] = p[hit] + 3
+        value_type = data[p + 2]
+        size = _AUX_SIZES[value_type]
+        string = (value_type == ord('Z')) | (value_type == ord('H'))
+        if string.any():
+            values = p[string] + 3
+            size[string] = nuls[np.searchsorted(nuls, values)] - values + 1
+        array = value_type == ord('B')
+        if array.any():
+            count = _gather(data, p[array] + 4, '<i4').astype(np.int64)
+            size[array] = 5 + count * _AUX_SIZES[data[p[array] + 3]]
+        position[active] = p + 3 + size
+        # stop at the tag, at the end of the record or on an unknown type
+        active = active[~hit & (size > 0) & (position[active] + 3 <= stop[active])]
+    return found
+
+
+def _read_group(data, start, stop, read_groups):
+    """Index in read_groups of the RG:Z value of each record, -1 when absent or unknown"""
+
+    group = np.full(len(start), -1, dtype=np.int64)
+    nuls = np.append(np.flatnonzero(data == 0), len(data))
+    found = _aux_tag(data, start, stop, b'RG', nuls)
+    length = np.where(found >= 0, nuls[np.searchsorted(nuls, np.maximum(found, 0))] - found, -1)
+    by_length = {}
+    for g, name in enumerate(read_groups):
+        by_length.setdefault(len(name.encode()), []).append((name.encode(), g))
+    for size, names in by_length.items():
+        records = np.flatnonzero(length == size)
+        if not len(records) or not size:
+            continue
+        names.sort()
+        keys = np.array([name for name, g in names], dtype='S%d' % size)
+        values = np.ascontiguousarray(data[found[records, None] + np.arange(size)]).view('S%d' % size).ravel()
+        position = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+        known = keys[position] == values
+        group[records[known]] = np.array([g for name, g in names], dtype=np.int64)[position[known]]
+    return group
+
+
+def _gather(data, positions, dtype):
+    """Read one little-endian value of type dtype at each byte position"""
+
+    width = np.dtype(dtype).itemsize
+    return data[positions[:, None] + np.arange(width)].view(dtype).ravel()
+
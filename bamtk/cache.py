@@ -0,0 +1,111 @@
+#########################################################################################
+#                                                                                       #
+#   cache.py - per-sample counts cache                                                  #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import hashlib
+import json
+import logging
+
+import numpy as np
+
+from biolib.common import make_sure_path_exists
+
+
+class CountsCache():
+    """Per-reference reads and bases counts of already counted alignment files.
+
+    An entry is keyed by the alignment file path, size and modification
+    time and by the filters applied while counting. Counts are kept per
+    reference of the BAM header, features grouping being applied later,
+    so only non-zero references are stored alongside a shared copy of
+    the header reference names.
+    """
+
+    def __init__(self, directory, min_mapq=0, id_cutoff=0):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.directory = directory
+        self.min_mapq = min_mapq
+        self.id_cutoff = id_cutoff
+        self._references = {}
+        make_sure_path_exists(directory)
+
+    def key(self, alignment_file):
+        """Cache key of an alignment file"""
+
+        stat = os.stat(alignment_file)
+        description = {'path': os.path.abspath(alignment_file),
+                       'size': stat.st_size,
+                       'mtime': stat.st_mtime_ns,
+                       'mapQ': self.min_mapq,
+                       'id_cutoff': self.id_cutoff}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get(self, alignment_file):
+        """Cached (references, reads, bases) of an alignment file, or None"""
+
+        entry = os.path.join(self.directory, self.key(alignment_file) + '.npz')
+        if not os.path.exists(entry):
+            return None
+
+        with np.load(entry) as data:
+            references = self._load_references(str(data['references']))
+            if references is None:
+                return None
+            reads = np.zeros(len(references), dtype=np.int64)
+            bases = np.zeros(len(references), dtype=np.int64)
+            reads[data['index']] = data['reads']
+            bases[data['index']] = data['bases']
+
+        return references, reads, bases
+
+    def put(self, alignment_file, counts):
+        """Store the (references, reads, bases) counts of an alignment file"""
+
+        references, reads, bases = counts
+        references_key = self._save_references(references)
+        index = np.flatnonzero((reads != 0) | (bases != 0))
+        entry = os.path.join(self.directory, self.key(alignment_file) + '.npz')
+        with open(entry + '.tmp', 'wb') as output_handle:
+            np.savez(output_handle, references=references_key, index=index,
+                     reads=reads[index], bases=bases[index])
+        os.replace(entry + '.tmp', entry)
+
+    def _save_references(self, references):
+        key = hashlib.sha1('\n'.join(references).encode()).hexdigest()
+        path = os.path.join(self.directory, 'references_' + key + '.txt')
+        if key not in self._references and not os.path.exists(path):
+            with open(path + '.tmp', 'w') as output_handle:
+                output_handle.write('\n'.join(references))
+            os.replace(path + '.tmp', path)
+        self._references[key] = references
+        return key
+
+    def _load_references(self, key):
+        if key not in self._references:
+            path = os.path.join(self.directory, 'references_' + key + '.txt')
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                content = f.read()
+            self._references[key] = content.split('\n') if content else []
+        return self._references[key]
@@ -0,0 +1,127 @@
+#########################################################################################
+#                                                                                       #
+#   counter.py - features counting library API                                          #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import logging
+
+import numpy as np
+
+from biolib.common import remove_extension
+
+from bamtk.bam import count_alignments, count_records
+from bamtk.features import FeatureIndex
+from bamtk.matrix import AbundanceMatrices
+
+
+class FeatureCounter():
+    """Count the features of a reference in samples added one at a time.
+
+    Library counterpart of mm_features: samples are counted in the
+    calling process and the matrices are returned instead of written.
+    Options have the meaning and defaults of the mm_features ones.
+
+        counter = FeatureCounter('contigs.fasta.fai', merge=True)
+        counter.add_sample('sample_1.bam', library_size=2500000)
+        tpm = counter.matrices().tpm()
+    """
+
+    def __init__(self, faidx, merge=False, separator='.', genome=False, genome_name=None,
+                 min_mapq=10, id_cutoff=0, samtools=False, threads=2,
+                 feature_normalisation=1000000, feature_size_normalisation=1000,
+                 discard_feature_length_normalisation=False, discard_library_size_normalisation=False,
+                 library_size_normalisation='total', compile_index=False):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        if genome_name is None:
+            genome_name = remove_extension(faidx, 'fasta.fai')
+        if compile_index:
+            self.index = FeatureIndex.compiled(faidx, merge, separator, genome, genome_name)
+        else:
+            self.index = FeatureIndex.from_faidx(faidx, merge, separator, genome, genome_name)
+
+        self.min_mapq = int(min_mapq)
+        self.id_cutoff = float(id_cutoff)
+        self.samtools = samtools
+        self.threads = threads
+        self.feature_normalisation = feature_normalisation
+        self.feature_size_normalisation = feature_size_normalisation
+        self.discard_feature_length_normalisation = discard_feature_length_normalisation
+        self.discard_library_size_normalisation = discard_library_size_normalisation
+        self.library_size_normalisation = library_size_normalisation
+
+        self.samples = []
+        self.library_sizes = []
+        self._reads = []
+        self._bases = []
+
+    def add_sample(self, bam_path, library_size=None, name=None):
+        """Count an alignment file, named after its file name by default"""
+
+        if name is None:
+            name = remove_extension(os.path.basename(bam_path), 'bam')
+        references, reads, bases = count_alignments(bam_path, self.min_mapq, self.id_cutoff,
+                                                    self.samtools, self.threads)
+        self.add_counts(name, references, reads, bases, library_size)
+
+    def add_records(self, name, records, library_size=None):
+        """Count an iterable of alignment records, see count_records()"""
+
+        references, reads, bases = count_records(records, self.min_mapq, self.id_cutoff)
+        self.add_counts(name, references, reads, bases, library_size)
+
+    def add_counts(self, name, references, reads, bases, library_size=None):
+        """Add a sample from its reads and matched bases count per reference"""
+
+        feature_reads, feature_bases = self.index.reduce(references, reads, bases)
+        if not library_size or self.discard_library_size_normalisation:
+            library_size = 1
+        self.samples.append(name)
+        self.library_sizes.append(int(library_size))
+        self._reads.append(feature_reads)
+        self._bases.append(feature_bases)
+
+    def matrices(self):
+        """AbundanceMatrices of the samples added so far"""
+
+        shape = (len(self.index), len(self.samples))
+        reads = np.zeros(shape, dtype=np.int64)
+        bases = np.zeros(shape, dtype=np.int64)
+        for j, (feature_reads, feature_bases) in enumerate(zip(self._reads, self._bases)):
+            reads[:, j] = feature_reads
+            bases[:, j] = feature_bases
+        return AbundanceMatrices(self.index.names, self.index.sizes, list(self.samples), reads, bases,
+                                 self.library_sizes, self.feature_normalisation,
+                                 self.feature_size_normalisation,
+                                 self.discard_feature_length_normalisation,
+                                 self.library_size_normalisation)
+
+    def arrays(self):
+        """Features x samples array of every measure, keyed by its mm_features file name.
+
+        Keys are 'features_reads_raw_count', 'TPM', then the reads and
+        base raw, normalised and relative abundances, e.g.
+        'features_base_relative_abundance'.
+        """
+
+        matrices = self.matrices()
+        return {os.path.splitext(filename)[0]: np.asarray(matrix())
+                for filename, description, matrix in matrices.matrices()}
@@ -0,0 +1,123 @@
+#########################################################################################
+#                                                                                       #
+#   coverage.py - breadth and depth of coverage of references                           #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import numpy as np
+
+
+class Coverage():
+    """Covered bases and summed depth of each reference, from aligned blocks.
+
+    Blocks of the current reference are folded into a difference array of
+    the reference length as they are added, and the array is reduced when
+    records move to another reference. Memory is bounded by the longest
+    reference as long as records are sorted by coordinate, a reference
+    seen again is flagged in unsorted and its breadth may be
+    over-estimated.
+    """
+
+    def __init__(self, n_groups=1, lengths=None, groups=None):
+        """Initialization.
+
+        n_groups is the number of read groups counted separately and
+        lengths the length of each reference id. Without lengths, the end
+        of the last block of a reference is used. groups gives the group
+        the blocks of each read group are added to, to cover several read
+        groups together.
+        """
+        self.n_groups = n_groups
+        self.lengths = lengths
+        self.groups = None if groups is None else np.asarray(groups, dtype=np.int64)
+        self.covered = {}
+        self.depth = {}
+        self.unsorted = False
+        self._reference = None
+        self._diff = None
+        self._depth = None
+        self._end = 0
+
+    def add(self, reference, starts, ends, groups=0):
+        """Add the aligned blocks [starts, ends) of a reference, 0-based"""
+
+        if reference != self._reference:
+            self.flush()
+            if reference in self.covered:
+                self.unsorted = True
+            self._reference = reference
+            size = 0 if self.lengths is None else int(self.lengths[reference])
+            self._diff = np.zeros((size + 1, self.n_groups), dtype=np.int32)
+            self._depth = np.zeros(self.n_groups, dtype=np.int64)
+            self._end = 0
+
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        groups = np.asarray(groups, dtype=np.int64)
+        if self.groups is not None:
+            groups = self.groups[groups]
+        groups = np.broadcast_to(groups, starts.shape)
+        if not len(starts):
+            return
+        if self.lengths is None:
+            self._end = max(self._end, int(ends.max()))
+            if self._end >= len(self._diff):
+                # grow the difference array to the furthest block end
+                diff = np.zeros((max(self._end + 1, 2 * len(self._diff)), self.n_groups), dtype=np.int32)
+                diff[:len(self._diff)] = self._diff
+                self._diff = diff
+        else:
+            length = len(self._diff) - 1
+            starts = np.clip(starts, 0, length)
+            ends = np.clip(ends, 0, length)
+
+        np.add.at(self._diff, (starts, groups), 1)
+        np.add.at(self._diff, (ends, groups), -1)
+        self._depth += np.bincount(groups, weights=ends - starts, minlength=self.n_groups).astype(np.int64)
+
+    def flush(self):
+        """Reduce the difference array of the current reference"""
+
+        if self._reference is None:
+            return
+        length = self._end if self.lengths is None else len(self._diff) - 1
+        depth = np.cumsum(self._diff[:length], axis=0, dtype=np.int32)
+        covered = np.count_nonzero(depth, axis=0)
+
+        self.covered[self._reference] = self.covered.get(self._reference, 0) + covered
+        self.depth[self._reference] = self.depth.get(self._reference, 0) + self._depth
+        self._reference = None
+        self._diff = None
+        self._depth = None
+
+    def arrays(self, rows, n_rows):
+        """Covered bases and summed depth arrays of n_rows references.
+
+        rows maps each reference to its row, None when references are
+        already row numbers. Arrays are references x read groups.
+        """
+
+        self.flush()
+        covered = np.zeros((n_rows, self.n_groups), dtype=np.int64)
+        depth = np.zeros((n_rows, self.n_groups), dtype=np.int64)
+        for reference, values in self.covered.items():
+            row = reference if rows is None else rows[reference]
+            covered[row] = values
+            depth[row] = self.depth[reference]
+        return covered, depth
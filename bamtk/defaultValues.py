@@ -25,7 +25,27 @@ import os
 class DefaultValues():
     """Default values for filenames and common constants."""
 
+    FEATURES_COUNT_FILE = 'features_reads_raw_count.tsv'
+
+    FEATURES_TPM_FILE = 'TPM.tsv'
+
+    FEATURES_STORE_FILE = 'features_abundance.npz'
+
+    FEATURES_BREADTH_FILE = 'features_coverage_breadth.tsv'
+
+    FEATURES_DEPTH_FILE = 'features_coverage_depth.tsv'
+
+    FEATURES_MTX_ROWS_FILE = 'features_rows.tsv'
+
+    FEATURES_MTX_COLUMNS_FILE = 'features_columns.tsv'
+
+    FEATURES_SHARD_FILE = 'features_shard_%d_of_%d.npz'
+
+    CACHE_DIR = 'counts_cache'
+
     FEATURES_ABUNDANCE_FILES = ['features_reads_raw_abundance.tsv','features_reads_normalised_abundance.tsv','features_reads_relative_abundance.tsv','features_base_raw_abundance.tsv','features_base_normalised_abundance.tsv','features_base_relative_abundance.tsv' ]
 
+    ROLLUP_FILE_PREFIX = 'level%d_'
+
     ANNOTATE_ABUNDANCE_FILES = ['annotate_reads_raw_abundance.tsv', 'annotate_reads_normalised_abundance.tsv', 'annotate_reads_relative_abundance.tsv', 'annotate_base_raw_abundance.tsv', 'annotate_base_normalised_abundance.tsv' , 'annotate_base_relative_abundance.tsv']
 
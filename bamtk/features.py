@@ -0,0 +1,258 @@
+#########################################################################################
+#                                                                                       #
+#   features.py - reference features index                                              #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import hashlib
+import json
+import logging
+import tempfile
+
+import numpy as np
+
+from bamtk.matrix import load_npz
+
+# version of the compiled features index layout
+INDEX_VERSION = 1
+
+
+class FeatureIndex():
+    """Integer id of each feature of a samtools fasta index.
+
+    Reference sequences are grouped into features by the --merge and
+    --genome options, features keep the order of their first sequence
+    in the faidx and their size is the sum of their sequences length.
+    """
+
+    def __init__(self, merge=False, separator='.', genome=False, genome_name=None):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.merge = merge
+        self.separator = separator
+        self.genome = genome
+        self.genome_name = genome_name
+
+        self._names = []
+        self._ids = None
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self._ref_names = []
+        self.ref_features = np.zeros(0, dtype=np.int64)
+        # sorted reference names and their faidx position, set by compile()
+        self._ref_sorted = None
+        self._ref_order = None
+        self._table_references = None
+        self._table = None
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def names(self):
+        """Feature names in feature id order"""
+        if not isinstance(self._names, list):
+            self._names = [name.decode() for name in self._names.tolist()]
+        return self._names
+
+    @property
+    def ref_names(self):
+        """Reference sequence names in faidx order"""
+        if self._ref_names is None:
+            ref_names = np.empty(len(self._ref_order), dtype=self._ref_sorted.dtype)
+            ref_names[self._ref_order] = self._ref_sorted
+            self._ref_names = [name.decode() for name in ref_names.tolist()]
+        return self._ref_names
+
+    @property
+    def ids(self):
+        """Feature id of each feature name"""
+        if self._ids is None:
+            self._ids = {name: i for i, name in enumerate(self.names)}
+        return self._ids
+
+    @classmethod
+    def from_faidx(cls, faidx, merge=False, separator='.', genome=False, genome_name=None):
+        """Read features and their size from a samtools fasta index"""
+
+        index = cls(merge, separator, genome, genome_name)
+        index._ids = {}
+        sizes = []
+        ref_features = []
+        with open(faidx) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                line_list = line.rstrip().split('\t')
+                features = index.feature_name(line_list[0])
+                feature_id = index._ids.get(features)
+                if feature_id is None:
+                    feature_id = len(index._names)
+                    index._ids[features] = feature_id
+                    index._names.append(features)
+                    sizes.append(0)
+                sizes[feature_id] += int(line_list[1])
+                index._ref_names.append(line_list[0])
+                ref_features.append(feature_id)
+
+        index.sizes = np.array(sizes, dtype=np.int64)
+        index.ref_features = np.array(ref_features, dtype=np.int64)
+        return index
+
+    @classmethod
+    def compiled(cls, faidx, merge=False, separator='.', genome=False, genome_name=None):
+        """Features index of a faidx, compiled next to it on first use.
+
+        The compiled index is rebuilt when the faidx size or modification
+        time changes. When it cannot be written, the parsed faidx index is
+        returned.
+        """
+
+        path = cls.compiled_path(faidx, merge, separator, genome, genome_name)
+        stamp = cls._faidx_stamp(faidx)
+        if os.path.exists(path):
+            try:
+                index = cls.load(path)
+                if index.faidx_stamp == stamp:
+                    return index
+            except (OSError, ValueError, KeyError) as error:
+                logging.getLogger('timestamp').warning('Cannot read compiled index %s: %s' % (path, error))
+
+        index = cls.from_faidx(faidx, merge, separator, genome, genome_name)
+        try:
+            index.save(path, stamp)
+        except OSError as error:
+            index.logger.warning('Cannot write compiled index %s: %s' % (path, error))
+        return index
+
+    @staticmethod
+    def compiled_path(faidx, merge=False, separator='.', genome=False, genome_name=None):
+        """Path of the compiled index of a faidx and grouping options"""
+
+        options = json.dumps([merge, separator, genome, genome_name if genome else None])
+        return '%s.%s.bamtk_index.npz' % (faidx, hashlib.sha1(options.encode()).hexdigest()[:12])
+
+    @staticmethod
+    def _faidx_stamp(faidx):
+        stat = os.stat(faidx)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def save(self, path, faidx_stamp):
+        """Write the index as an uncompressed npz, memory-mappable by load()"""
+
+        ref_names = np.array([name.encode() for name in self.ref_names], dtype=bytes)
+        ref_order = np.argsort(ref_names, kind='stable')
+        # a temporary file of its own for each writer, runs sharing the faidx may race
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output_handle:
+                np.savez(output_handle,
+                         version=INDEX_VERSION,
+                         faidx_stamp=np.array(faidx_stamp, dtype=np.int64),
+                         options=json.dumps([self.merge, self.separator, self.genome, self.genome_name]),
+                         names=np.array([name.encode() for name in self.names], dtype=bytes),
+                         sizes=self.sizes,
+                         ref_features=self.ref_features,
+                         ref_sorted=ref_names[ref_order],
+                         ref_order=ref_order)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a compiled index written by save()"""
+
+        data = load_npz(path, mmap_mode='r' if mmap else None)
+        if int(data['version']) != INDEX_VERSION:
+            raise ValueError('unsupported compiled index version %s' % int(data['version']))
+        index = cls(*json.loads(str(data['options'])))
+        index.faidx_stamp = data['faidx_stamp'].tolist()
+        index._names = data['names']
+        index.sizes = data['sizes']
+        index.ref_features = data['ref_features']
+        index._ref_sorted = data['ref_sorted']
+        index._ref_order = data['ref_order']
+        index._ref_names = None
+        return index
+
+    def feature_name(self, reference):
+        """Feature a reference sequence belongs to"""
+
+        if self.genome:
+            return self.genome_name
+        if self.merge:
+            return self.separator.join(reference.split(self.separator)[:-1])
+        return reference
+
+    def reference_table(self, references):
+        """Feature id of each reference name, -1 for unknown features"""
+
+        if self._table_references is references or self._table_references == references:
+            return self._table
+        if self._ref_sorted is not None:
+            table = self._compiled_table(references)
+        elif references == self.ref_names:
+            table = self.ref_features
+        else:
+            table = np.array([self.ids.get(self.feature_name(r), -1) for r in references], dtype=np.int64)
+        self._table_references = references
+        self._table = table
+        return table
+
+    def _compiled_table(self, references):
+        """Resolve reference names with a binary search of the faidx names"""
+
+        names = np.array([r.encode() for r in references], dtype=bytes)
+        if len(self._ref_sorted) == 0:
+            position = np.zeros(len(names), dtype=np.int64)
+            found = np.zeros(len(names), dtype=bool)
+        else:
+            position = np.minimum(np.searchsorted(self._ref_sorted, names), len(self._ref_sorted) - 1)
+            found = self._ref_sorted[position] == names
+        table = np.full(len(names), -1, dtype=np.int64)
+        table[found] = self.ref_features[self._ref_order[position[found]]]
+        # references absent from the faidx may still belong to a known group
+        for i in np.flatnonzero(~found):
+            table[i] = self.ids.get(self.feature_name(references[i]), -1)
+        return table
+
+    def reference_mask(self, references, features):
+        """Mask of the references belonging to the given feature ids"""
+
+        selected = np.zeros(len(self) + 1, dtype=bool)
+        selected[features] = True
+        # unknown references, -1 in the table, hit the last False entry
+        return selected[self.reference_table(references)]
+
+    def reduce(self, references, *ref_counts):
+        """Sum per reference counts arrays into per feature counts arrays"""
+
+        table = self.reference_table(references)
+        known = table >= 0
+        if not known.all():
+            unknown = np.flatnonzero(~known & (np.asarray(ref_counts[0]) != 0))
+            for i in unknown:
+                self.logger.warning("'%s' not present in the reference index" % references[i])
+
+        return [np.bincount(table[known], weights=np.asarray(counts)[known],
+                            minlength=len(self)).astype(np.asarray(counts).dtype)
+                for counts in ref_counts]
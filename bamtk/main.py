@@ -17,361 +17,808 @@
 
 import os
 import sys
+import json
+import time
+import hashlib
+import tempfile
+import subprocess
 
 import logging
-import subprocess
-import re 
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 
 from biolib.common import (make_sure_path_exists, 
                             check_dir_exists,
                             check_file_exists,
                             remove_extension)
 
+from bamtk.annotation import AnnotationIndex, RollupIndex
+from bamtk.bam import BamIndex, BamReader, count_alignments, parse_read_groups
 from bamtk.common import findEx
+from bamtk.cache import CountsCache
+from bamtk.features import FeatureIndex
+from bamtk.matrix import AbundanceMatrices, MatrixWriter, SparseMatrix, find_matrix, open_matrix, query_matrix, zstandard
+from bamtk.metrics import Metrics
 from bamtk.defaultValues import DefaultValues
 
 
-class OptionsParser():
+class FeaturesCounts():
+    """Reads and bases counts of each feature, filled one sample at a time.
+
+    Counts are kept dense in memory, dense in an anonymous file with
+    --max_memory, or as the non-zero features of each sample with
+    --sparse and --format mtx. Without with_bases only reads are kept
+    and the bases matrix is None. with_coverage adds the covered bases
+    and summed depth matrices.
+    """
 
-    def __init__(self):
+    def __init__(self, options, n_features, n_samples, with_bases=True, with_coverage=False):
         """Initialization"""
-        self.logger = logging.getLogger('timestamp')
+        self.shape = (n_features, n_samples)
+        self.sparse = getattr(options, 'sparse', False) or options.format == 'mtx'
+        self.reads = self.new_counts(options)
+        self.bases = self.new_counts(options) if with_bases else None
+        self.covered = self.new_counts(options) if with_coverage else None
+        self.depth = self.new_counts(options) if with_coverage else None
+
+    def new_counts(self, options):
+        if self.sparse :
+            return []
+        if options.max_memory :
+            # spill the counts of each finished sample to disk
+            with tempfile.TemporaryFile(dir=options.output_dir) as spill :
+                return np.memmap(spill, dtype=np.int64, mode='w+', shape=self.shape, order='F')
+        return np.zeros(self.shape, dtype=np.int64)
+
+    def set(self, i, reads, bases=None, covered=None, depth=None):
+        """Set the counts of the i-th sample"""
+
+        for counts, values in ((self.reads, reads), (self.bases, bases),
+                               (self.covered, covered), (self.depth, depth)) :
+            if counts is None :
+                continue
+            if self.sparse :
+                rows = np.flatnonzero(values)
+                counts.append((i, rows, values[rows]))
+            else :
+                counts[:, i] = values
 
-    def features(self,options):
-        """Making bam features matrix"""
+    def add(self, i, reads, bases=None, covered=None, depth=None):
+        """Add counts to the i-th sample, counted in several parts"""
 
-        make_sure_path_exists(options.output_dir)
-        reads_abundance = os.path.join(options.output_dir,  DefaultValues.FEATURES_ABUNDANCE_FILES[0])
-        reads_normalised = os.path.join(options.output_dir, DefaultValues.FEATURES_ABUNDANCE_FILES[1])
-        reads_relative = os.path.join(options.output_dir,   DefaultValues.FEATURES_ABUNDANCE_FILES[2])
-        base_abundance = os.path.join(options.output_dir,   DefaultValues.FEATURES_ABUNDANCE_FILES[3])
-        base_normalised = os.path.join(options.output_dir,  DefaultValues.FEATURES_ABUNDANCE_FILES[4])
-        base_relative = os.path.join(options.output_dir,    DefaultValues.FEATURES_ABUNDANCE_FILES[5])
-        reads_count = os.path.join(options.output_dir,  'features_reads_raw_count.tsv')
-        tpm_count = os.path.join(options.output_dir,  'TPM.tsv')
-
-        features_size = {}
-        raw_counts = {}
-        rpk = {}
-        counts = {}
-        counts_base = {}
+        if self.sparse :
+            # cells given several times are summed by SparseMatrix.from_columns()
+            self.set(i, reads, bases, covered, depth)
+            return
+        for counts, values in ((self.reads, reads), (self.bases, bases),
+                               (self.covered, covered), (self.depth, depth)) :
+            if counts is not None :
+                counts[:, i] += values
 
-        reference = remove_extension(options.faidx,options.faidx_extension)
+    def matrices(self, kinds=('reads', 'bases')):
+        """Reads and bases features x samples matrices, or the given kinds of counts"""
 
-        self.logger.info('Get features and initialise matrix')
-        with open(options.faidx) as f:
-            for line in f:
-                if not line.startswith('#') :
-                    line_list = line.rstrip().split('\t')
-                    features = line_list[0]
-                    if options.merge : 
-                        features = options.separator.join(features.split(options.separator)[:-1])
-                    if options.genome : 
-                        features = reference 
-                    try : 
-                        features_size[features] = features_size[features] + int(line_list[1])
-                    except KeyError:
-                        features_size[features] = int(line_list[1])
-                    counts[features] = 0 
-                    counts_base[features] = 0 
-                    raw_counts[features] = 0 
-                    rpk[features] = 0 
-
-
-        counts_raw_all = []
-        counts_tpm_all = []
-        counts_all = []
-        counts_all_normalised = []
-        counts_all_relative = []
-        counts_base_all = []
-        counts_base_all_normalised = []
-        counts_base_all_relative = []
-
-        header = ["Features","Features_size"]
-        self.logger.info('Browse alignement file(s)')
+        counts = [getattr(self, kind) for kind in kinds]
+        if self.sparse :
+            return tuple(None if c is None else SparseMatrix.from_columns(c, self.shape) for c in counts)
+        return tuple(counts)
 
-        samtoolsexec=findEx('samtools')
-        samtoolsthreads='-@ ' + options.threads
-        samtoolsminqual='-q ' + options.mapQ
 
+class OptionsParser():
+
+    def __init__(self, index_cache=None):
+        """Initialization.
+
+        index_cache is an IndexCache sharing parsed reference and
+        annotation indexes between the jobs of a bamtk server.
+        """
+        self.logger = logging.getLogger('timestamp')
+        self.metrics = Metrics()
+        self.index_cache = index_cache
+
+    def read_bam_list(self, options):
+        """Read alignment files, library sizes and sample names from bam_list"""
+
+        samples = []
         with open(options.bam_list,'r') as b :
             for bam in b :
                 if bam.startswith('#') :
                     continue
-                i = 0
-                alignementfile,librarysize = bam.split('\t')
-                if librarysize == '' or librarysize == 0 or options.discard_library_size_normalisation :
+                alignementfile,librarysize = bam.rstrip('\n').split('\t')
+                if librarysize.strip() == '' or int(librarysize) == 0 or options.discard_library_size_normalisation :
                     librarysize = 1 
+                librarysize = int(librarysize)
                 samplename = remove_extension(os.path.basename(alignementfile),options.extension)
-                header.append(samplename)
-                self.logger.info('\t'+samplename)
-                cmd = [ samtoolsexec,'view',samtoolsthreads,samtoolsminqual, alignementfile ]
-                p = subprocess.Popen(cmd, stdout=subprocess.PIPE).stdout
-                for line in p:
-                    try : 
-                        k=line
-                        line=line.decode(sys.getdefaultencoding()).rstrip()
-                        l=k
-                    except : 
-                        print(l)
-                        print(line)
-                        sys.exit()
-                    if i > 0 and i % 1000000 == 0 :
-                        self.logger.info("Alignment record %s processed" % i )
-                    i += 1
-                    line_list = line.split('\t')
-                    features = line_list[2]
-                    if options.merge : 
-                        features = options.separator.join(features.split(options.separator)[:-1])
-                    if options.genome : 
-                        features = reference
-                    cigar = line_list[5]
-                    base_mapped = 0 
-                    match = re.findall(r'(\d+)M',cigar)
-                    read_len = len(line_list[6])  
-                    for base_match in match :
-                        base_mapped += int(base_match)
-                    if read_len == 0 :
-                        self.logger.info(line_list)
-
-                    if base_mapped/read_len < float(options.id_cutoff) : 
-                        continue 
-                
-                    raw_counts[features] += 1 
-                    rpk[features] += (1 /  int(features_size[features])) * 1000
-                    if options.discard_feature_length_normalisation :
-                        counts_base[features] += base_mapped
-                        counts[features] += 1
-                    else :
-                        counts_base[features] += (base_mapped / int(features_size[features])) * options.feature_size_normalisation
-                        counts[features] += (1 / int(features_size[features])) * options.feature_size_normalisation
-
-                if options.library_size_normalisation == 'aligned' :
-                    librarysize = sum(counts.values())
-                    if librarysize == 0 : 
-                        librarysize = 1 
-
-                # raw reads count wo gl 
-                counts_raw_all.append(raw_counts.copy())
-
-                # rpk 
-                count_tmp = {}
-                try :
-                    count_tmp = {k: v * 1000000 / total for total in (sum(rpk.values()),) for k, v in rpk.items()}
-                except ZeroDivisionError:
-                    count_tmp = {k: v for k, v in counts.items()}
-                counts_tpm_all.append(count_tmp.copy())
-
-                # raw reads count 
-                counts_all.append(counts.copy())
-                # normalised reads count
-                count_tmp = {}
-                count_tmp = {k: (v / int(librarysize))*options.feature_normalisation for k, v in counts.items()} 
-                counts_all_normalised.append(count_tmp.copy())
-
-                # relative reads count
-                count_tmp = {}
-                try :
-                    count_tmp = {k: v / total for total in (sum(counts.values()),) for k, v in counts.items()}
-                except ZeroDivisionError:
-                    count_tmp = {k: v for k, v in counts.items()}
-                counts_all_relative.append(count_tmp.copy())
-
-                # raw bases count 
-                counts_base_all.append(counts_base.copy())
-
-                # normalised bases count
-                count_tmp = {}
-                count_tmp = {k: (v / int(librarysize))*options.feature_normalisation for k, v in counts_base.items()} 
-                counts_base_all_normalised.append(count_tmp.copy())
-
-                # relative bases count
-                count_tmp = {}
-                try :
-                    count_tmp = {k: v / total for total in (sum(counts_base.values()),) for k, v in counts_base.items()} 
-                except ZeroDivisionError:
-                    count_tmp = {k: v for k, v in counts_base.items()}
-                counts_base_all_relative.append(count_tmp.copy())
-
-                for fn in counts:
-                    raw_counts[fn] = 0
-                    counts[fn] = 0
-                    counts_base[fn] = 0
-
-        self.logger.info('Print matrices')
-        self.logger.info('Print raw reads count matrix in %s' % reads_count)
-        output_handle = open(reads_count, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts.keys():
-            if sum([c[fn] for c in counts_raw_all]) == 0 and options.removed :
-                continue
-            else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_raw_all])+'\n') 
-        output_handle.close()
-
-        self.logger.info('Print TMP matrix in %s' % tpm_count)
-        output_handle = open(tpm_count, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts.keys():
-            if sum([c[fn] for c in counts_tpm_all]) == 0 and options.removed :
-                continue
-            else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_tpm_all])+'\n') 
-        output_handle.close()
-
-        self.logger.info('Print raw reads abundance matrix in %s' % reads_abundance)
-        output_handle = open(reads_abundance, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts.keys():
-            if sum([c[fn] for c in counts_all]) == 0 and options.removed :
-                continue
-            else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_all])+'\n') 
-        output_handle.close()
-        
-        self.logger.info('Print normalised reads abundance matrix in %s' % reads_normalised)
-        output_handle = open(reads_normalised, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts.keys():
-            if sum([c[fn] for c in counts_all_normalised]) == 0 and options.removed :
-                continue
-            else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_all_normalised])+'\n') 
-        output_handle.close()
-
-        self.logger.info('Print relative reads abundance matrix in %s' % reads_normalised)
-        output_handle = open(reads_relative, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts.keys():
-            if sum([c[fn] for c in counts_all_relative]) == 0 and options.removed :
-                continue
+                samples.append((alignementfile, librarysize, samplename))
+
+        return samples
+
+    def count_samples(self, samples, options, callback, targets=None, read_groups=None):
+        """Count reads and bases per reference for each sample.
+
+        callback(i, (references, reads, bases)) is called as soon as the
+        i-th sample of the bam_list is counted. With --jobs > 1 samples
+        are counted in a process pool, largest alignment files first. Files
+        with a BAI index are split into reference ranges counted by
+        different workers and summed back. targets(references) is the mask
+        of the references to count with --features_list: only their
+        indexed records are read. With read_groups, the (read group ids,
+        columns) of each sample from read_group_columns(), counts are
+        references x read groups arrays.
+        With --cache, counts of unchanged alignment files are read from the
+        output directory and each newly counted sample is stored as soon as
+        it is done. Records counters of each sample are added to the run
+        metrics.
+        """
+
+        count_args = (int(options.mapQ), float(options.id_cutoff), options.samtools, options.threads)
+        coverage = getattr(options, 'coverage', False)
+        def count_kwargs(i):
+            kwargs = {'coverage': True} if coverage else {}
+            if read_groups is not None :
+                ids, columns = read_groups[i]
+                kwargs['read_groups'] = ids
+                if coverage :
+                    # read groups of a column are covered together
+                    first = {}
+                    kwargs['coverage_groups'] = [first.setdefault(column, g)
+                                                 for g, column in enumerate(columns.tolist())]
+            return kwargs
+        done = [False] * len(samples)
+
+        cache = None
+        if options.cache and targets is not None :
+            self.logger.warning('--cache is not used to count a features list')
+        elif options.cache and read_groups is not None :
+            self.logger.warning('--cache is not used to count read groups')
+        elif options.cache and coverage :
+            self.logger.warning('--cache is not used to compute coverage')
+        elif options.cache :
+            cache = CountsCache(os.path.join(options.output_dir, DefaultValues.CACHE_DIR),
+                                int(options.mapQ), float(options.id_cutoff))
+            for i, (alignementfile, librarysize, samplename) in enumerate(samples) :
+                counts = cache.get(alignementfile)
+                if counts is not None :
+                    self.logger.info('\t%s read from cache' % samplename)
+                    done[i] = True
+                    self.metrics.sample(samplename, alignementfile, [], cached=True)
+                    callback(i, counts)
+        todo = [i for i in range(len(samples)) if not done[i]]
+
+        def counted(i, counts, stats, wall=None):
+            done[i] = True
+            self.metrics.sample(samples[i][2], samples[i][0], stats, wall)
+            if cache is not None :
+                cache.put(samples[i][0], counts)
+            callback(i, counts)
+
+        if options.jobs <= 1 and targets is None :
+            for i in todo :
+                self.logger.info('\t'+samples[i][2])
+                counts = count_alignments(samples[i][0], *count_args, with_stats=True, **count_kwargs(i))
+                counted(i, counts[:-1], [counts[-1]], counts[-1]['wall_seconds'])
+            return
+
+        # split indexed alignment files into reference ranges counted separately
+        tasks = []
+        for i in todo :
+            alignementfile = samples[i][0]
+            regions = self.sample_regions(alignementfile, options, targets)
+            if regions is None :
+                tasks.append((os.path.getsize(alignementfile), i, None))
+            elif not regions and targets is not None :
+                self.logger.info('\t%s has no record on the features list' % samples[i][2])
+                shape = 0 if read_groups is None else (0, len(read_groups[i][0]))
+                counted(i, ([],) + tuple(np.zeros(shape, dtype=np.int64) for n in range(4 if coverage else 2)), [])
+            for region in regions or [] :
+                tasks.append(((region[3] >> 16) - (region[2] >> 16), i, region))
+
+        partial = {}
+        remaining = [0] * len(samples)
+        for size, i, region in tasks :
+            remaining[i] += 1
+
+        def part_counted(i, *counts):
+            counts, stats = counts[:-1], counts[-1]
+            if i not in partial :
+                partial[i] = (counts, [stats])
             else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_all_relative])+'\n')
-        output_handle.close()
-
-        self.logger.info('Print raw base abundance matrix in %s' % reads_normalised)
-        output_handle = open(base_abundance, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts_base.keys():
-            if sum([c[fn] for c in counts_all]) == 0 and options.removed :
-                continue
+                for total, part in zip(partial[i][0][1:], counts[1:]) :
+                    total[:] += part
+                partial[i][1].append(stats)
+            remaining[i] -= 1
+            if remaining[i] == 0 :
+                self.logger.info('\t%s counted' % samples[i][2])
+                counted(i, *partial.pop(i))
+
+        if options.jobs > 1 and len(tasks) > 1 :
+            tasks.sort(key=lambda task: task[0], reverse=True)
+            with ProcessPoolExecutor(max_workers=options.jobs) as executor :
+                futures = {executor.submit(count_alignments, samples[i][0], *count_args, region=region,
+                                           with_stats=True, **count_kwargs(i)): i
+                            for size, i, region in tasks}
+                for future in as_completed(futures):
+                    part_counted(futures[future], *future.result())
+        else :
+            for size, i, region in tasks :
+                part_counted(i, *count_alignments(samples[i][0], *count_args, region=region, with_stats=True,
+                                                  **count_kwargs(i)))
+
+        # indexed files without any placed record
+        for i in todo :
+            if not done[i] :
+                counts = count_alignments(samples[i][0], *count_args, with_stats=True, **count_kwargs(i))
+                counted(i, counts[:-1], [counts[-1]], counts[-1]['wall_seconds'])
+
+    def index_samples(self, samples, callback):
+        """Mapped reads per reference of each sample, read from their BAI index only.
+
+        callback(i, (references, reads, None)) is called for the i-th
+        sample of the bam_list. Only the BAM header is decompressed, but
+        for the references without mapped reads count in the index whose
+        records are counted.
+        """
+
+        for i, (alignementfile, librarysize, samplename) in enumerate(samples) :
+            index = BamIndex.find(alignementfile)
+            if index is None :
+                self.logger.error('%s has no BAI index, required by --fast_index' % alignementfile)
+                sys.exit(1)
+            self.logger.info('\t'+samplename)
+            wall = time.perf_counter()
+            reader = BamReader(alignementfile)
+            references = reader.references
+            reader.close()
+            index = BamIndex(index)
+            mapped = np.array([count or 0 for count in index.mapped], dtype=np.int64)
+            missing = [r for r, count in enumerate(index.mapped) if count is None]
+            if missing :
+                self.logger.warning('%s has no mapped reads count for %d reference(s), they are counted from their records: %s%s' % (
+                    index.path, len(missing), ', '.join(references[r] for r in missing[:10]),
+                    ' ...' if len(missing) > 10 else ''))
+                counted = np.zeros(len(references), dtype=np.int64)
+                for region in index.targets(missing) :
+                    counted += count_alignments(alignementfile, region=region)[1]
+                mapped[missing] = counted[missing]
+            stats = {'records': int(mapped.sum()) + int(sum(count or 0 for count in index.unmapped)),
+                     'counted': int(mapped.sum()),
+                     'wall_seconds': time.perf_counter() - wall}
+            self.metrics.sample(samplename, alignementfile, [stats])
+            callback(i, (references, mapped, None))
+
+    def sample_regions(self, alignementfile, options, targets=None):
+        """BAI regions of an alignment file to count separately, None to read it whole.
+
+        Without targets the references are split into --jobs ranges,
+        otherwise regions only cover the references of the targets mask.
+        """
+
+        index = None if options.samtools else BamIndex.find(alignementfile)
+        if index is None :
+            if targets is not None :
+                self.logger.warning('%s has no BAI index, it is read entirely' % alignementfile)
+            return None
+        if targets is None :
+            return BamIndex(index).regions(options.jobs)
+        reader = BamReader(alignementfile)
+        references = reader.references
+        reader.close()
+        return BamIndex(index).targets(np.flatnonzero(targets(references)))
+
+    def feature_index(self, options, reference):
+        """Features index of the faidx and grouping options"""
+
+        def build():
+            if getattr(options, 'compile_index', False) :
+                return FeatureIndex.compiled(options.faidx, options.merge, options.separator,
+                                             options.genome, reference)
+            return FeatureIndex.from_faidx(options.faidx, options.merge, options.separator,
+                                           options.genome, reference)
+
+        if self.index_cache is None :
+            return build()
+        key = ('features', os.path.abspath(options.faidx), options.merge, options.separator,
+               options.genome, reference, getattr(options, 'compile_index', False))
+        return self.index_cache.get(key, [options.faidx], build)
+
+    def annotation_index(self, options):
+        """Annotation index of the features annotation and description files"""
+
+        def build():
+            return AnnotationIndex(options.features_annotation, options.annotation_description)
+
+        if self.index_cache is None :
+            return build()
+        key = ('annotation', os.path.abspath(options.features_annotation),
+               os.path.abspath(options.annotation_description))
+        annotations = self.index_cache.get(key, [options.features_annotation, options.annotation_description], build)
+        # warnings of a cached index are reported again for each job
+        annotations.reset_warnings()
+        return annotations
+
+    def rollup_indexes(self, options, annotations):
+        """Rollup index of each --rollup mapping file, from the annotations level up"""
+
+        mappings = getattr(options, 'rollup', None) or []
+        for mapping in mappings :
+            check_file_exists(mapping)
+
+        def build():
+            levels = []
+            names = annotations.names
+            for mapping in mappings :
+                try:
+                    levels.append(RollupIndex(mapping, names))
+                except ValueError as error:
+                    self.logger.error(str(error))
+                    sys.exit(1)
+                names = levels[-1].names
+            return levels
+
+        if self.index_cache is None or not mappings :
+            return build()
+        key = ('rollup', os.path.abspath(options.features_annotation),
+               os.path.abspath(options.annotation_description)) + tuple(os.path.abspath(m) for m in mappings)
+        levels = self.index_cache.get(key, [options.features_annotation, options.annotation_description] + mappings,
+                                      build)
+        for index in levels :
+            index.reset_warnings()
+        return levels
+
+    def features(self,options):
+        """Making bam features matrix"""
+
+        make_sure_path_exists(options.output_dir)
+
+        reference = remove_extension(options.faidx,options.faidx_extension)
+
+        self.logger.info('Get features and initialise matrix')
+        with self.metrics.stage('faidx_load') :
+            index = self.feature_index(options, reference)
+
+        self.logger.info('Browse alignement file(s)')
+        samples = self.read_bam_list(options)
+        shard = getattr(options, 'shard', None)
+        if shard :
+            # deterministic subset of the bam_list: every N-th sample from the i-th
+            positions = list(range(shard[0] - 1, len(samples), shard[1]))
+            self.logger.info('Shard %d/%d: %d of %d sample(s)' % (shard[0], shard[1], len(positions), len(samples)))
+            metadata = self.shard_metadata(options, reference, shard, positions, samples)
+            samples = [samples[i] for i in positions]
+
+        features, sizes = index.names, index.sizes
+        rows = targets = None
+        if getattr(options, 'features_list', None) :
+            rows = self.read_features_list(options.features_list, index)
+            features, sizes = [features[r] for r in rows.tolist()], sizes[rows]
+            targets = lambda references: index.reference_mask(references, rows)
+
+        fast_index = getattr(options, 'fast_index', False)
+        if fast_index :
+            self.logger.warning('--fast_index: reads counts are the mapped reads of the BAI indexes, '
+                                '--mapQ and --id_cutoff are not applied and base matrices are not available')
+
+        coverage = getattr(options, 'coverage', False)
+        if coverage and fast_index :
+            self.logger.error('--coverage cannot be computed from the BAI indexes with --fast_index')
+            sys.exit(1)
+
+        columns = [(samplename, librarysize) for alignementfile, librarysize, samplename in samples]
+        groups = None
+        if getattr(options, 'by_read_group', False) :
+            if shard or fast_index :
+                self.logger.error('--by_read_group cannot be used with --shard or --fast_index')
+                sys.exit(1)
+            groups, columns = self.read_group_columns(samples, options)
+        counts = FeaturesCounts(options, len(features), len(columns), not fast_index, coverage)
+
+        def add_sample(i, counts_):
+            references = counts_[0]
+            ref_counts = [c for c in counts_[1:] if c is not None]
+            if groups is None :
+                parts = [(i, ref_counts)]
             else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_base_all])+'\n') 
-        output_handle.close()
-
-        self.logger.info('Print normalised base abundance matrix in %s' % reads_normalised)
-        output_handle = open(base_normalised, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts_base.keys():
-            if sum([c[fn] for c in counts_all_normalised]) == 0 and options.removed :
-                continue
+                # sum the read groups sharing a column
+                parts = [(column, [c[:, groups[i][1] == column].sum(axis=1) for c in ref_counts])
+                         for column in np.unique(groups[i][1]).tolist()]
+            for column, column_counts in parts :
+                with self.metrics.stage('features_reduce') :
+                    feature_counts = index.reduce(references, *column_counts)
+                if rows is not None :
+                    feature_counts = [c[rows] for c in feature_counts]
+                counts.add(column, *feature_counts)
+
+        with self.metrics.stage('alignments_count') :
+            if fast_index :
+                self.index_samples(samples, add_sample)
             else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_base_all_normalised])+'\n') 
-        output_handle.close()
-
-        self.logger.info('Print relative base abundance matrix in %s' % reads_normalised)
-        output_handle = open(base_relative, "w")
-        output_handle.write('\t'.join(header)+'\n')
-        for fn in counts_base.keys():
-            if sum([c[fn] for c in counts_all_relative]) == 0 and options.removed :
-                continue
+                self.count_samples(samples, options, add_sample, targets, groups)
+
+        reads, bases, covered, depth = counts.matrices(('reads', 'bases', 'covered', 'depth'))
+        matrices = AbundanceMatrices(features, sizes,
+                                     [name for name, librarysize in columns],
+                                     reads, bases,
+                                     [librarysize for name, librarysize in columns],
+                                     options.feature_normalisation,
+                                     options.feature_size_normalisation,
+                                     options.discard_feature_length_normalisation,
+                                     options.library_size_normalisation,
+                                     covered, depth)
+        if options.max_memory :
+            matrices.set_max_memory(options.max_memory * 1024 * 1024)
+
+        if shard :
+            matrices.metadata = metadata
+            store = os.path.join(options.output_dir, DefaultValues.FEATURES_SHARD_FILE % tuple(shard))
+            self.logger.info('Save shard features counts in %s' % store)
+            with self.metrics.stage('matrix_write') :
+                matrices.save(store)
+            return matrices
+
+        self.write_features(options, matrices)
+        return matrices
+
+    def read_group_columns(self, samples, options):
+        """Read groups of each alignment file and the matrices columns they are counted in.
+
+        Columns are named after the SM, or ID, of the @RG header lines and
+        the read groups sharing a name are summed in one column, whether
+        they are in the same file or in several files.
+        Returns the (read group ids, column of each read group) of each
+        file and the (name, library size) of each column, library sizes
+        being read from --read_group_library_size.
+        """
+
+        groups = []
+        names = []
+        owners = {}
+        shared = set()
+        for alignementfile, librarysize, samplename in samples :
+            if options.samtools :
+                header = subprocess.run([findEx('samtools'), 'view', '-H', alignementfile],
+                                        stdout=subprocess.PIPE, check=True).stdout.decode()
+                read_groups = parse_read_groups(header)
             else :
-                output_handle.write('\t'.join([fn] + [str(features_size[fn])] + [str(c[fn]) for c in counts_base_all_relative])+'\n')
-        output_handle.close()
-
-        self.logger.info('Matrices printed')
+                reader = BamReader(alignementfile)
+                read_groups = reader.read_groups
+                reader.close()
+            if not read_groups :
+                self.logger.error('%s has no @RG header line, required by --by_read_group' % alignementfile)
+                sys.exit(1)
+            positions = []
+            for group_id, name in read_groups :
+                if owners.setdefault(name, alignementfile) != alignementfile :
+                    shared.add(name)
+                if name not in names :
+                    names.append(name)
+                positions.append(names.index(name))
+            groups.append(([group_id for group_id, name in read_groups], np.array(positions, dtype=np.int64)))
+            self.logger.info('\t%s: %d read group(s)' % (samplename, len(read_groups)))
+        if shared :
+            if getattr(options, 'coverage', False) :
+                self.logger.error('--coverage cannot be computed for read group samples spread over several alignment files: %s'
+                                  % ', '.join(sorted(shared)))
+                sys.exit(1)
+            self.logger.info('%d read group sample(s) summed over several alignment files' % len(shared))
+
+        library_sizes = {}
+        if getattr(options, 'read_group_library_size', None) :
+            check_file_exists(options.read_group_library_size)
+            with open(options.read_group_library_size) as f :
+                for line in f :
+                    if line.startswith('#') or not line.strip() :
+                        continue
+                    name, librarysize = line.rstrip('\n').split('\t')[:2]
+                    library_sizes[name] = int(librarysize)
+            missing = [name for name in names if name not in library_sizes]
+            if missing :
+                self.logger.warning('No library size for %d read group(s), they are not normalised: %s' % (
+                    len(missing), ', '.join(missing)))
+        columns = []
+        for name in names :
+            librarysize = library_sizes.get(name, 0)
+            if librarysize == 0 or options.discard_library_size_normalisation :
+                librarysize = 1
+            columns.append((name, librarysize))
+        return groups, columns
+
+    def read_features_list(self, features_list, index):
+        """Feature ids of the features, or merged features, listed in features_list"""
+
+        check_file_exists(features_list)
+        with open(features_list) as f:
+            names = [line.rstrip('\n').split('\t')[0] for line in f if line.strip() and not line.startswith('#')]
+        missing = [name for name in names if name not in index.ids]
+        if missing :
+            self.logger.warning('%d listed features not in the reference index: %s%s' % (
+                len(missing), ', '.join(missing[:10]), ' ...' if len(missing) > 10 else ''))
+        rows = np.unique(np.array([index.ids[name] for name in names if name in index.ids], dtype=np.int64))
+        if not len(rows) :
+            self.logger.error('No feature of %s in the reference index' % features_list)
+            sys.exit(1)
+        self.logger.info('Count %d listed feature(s) of %d' % (len(rows), len(index)))
+        return rows
+
+    def write_features(self, options, matrices):
+        """Write features matrices in the --format of options"""
+
+        if getattr(options, 'no_feature_matrices', False) :
+            self.logger.info('Features matrices not written')
+        elif options.format == 'npz' :
+            store = os.path.join(options.output_dir, DefaultValues.FEATURES_STORE_FILE)
+            self.logger.info('Save features counts in %s' % store)
+            with self.metrics.stage('matrix_write') :
+                matrices.save(store)
+        elif options.format == 'mtx' :
+            self.logger.info('Print sparse matrices')
+            matrices.write_mtx(options.output_dir, self.metrics,
+                               getattr(options, 'precision', None), getattr(options, 'compress', None))
+            self.logger.info('Matrices printed')
+        else :
+            self.logger.info('Print matrices')
+            matrices.write(options.output_dir, options.removed, self.metrics,
+                           getattr(options, 'precision', None), getattr(options, 'compress', None))
+            self.logger.info('Matrices printed')
+
+    def shard_metadata(self, options, reference, shard, positions, samples):
+        """Provenance of a shard store, checked by mm_merge.
+
+        Shards may run on different nodes, where the faidx and bam_list
+        have other paths and modification times: mm_merge compares the
+        samples and library sizes of the bam_list, and the features and
+        sizes of the stores, the paths in 'sources' are for information.
+        """
+
+        stat = os.stat(options.faidx)
+        bam_list = json.dumps([[name, str(library_size)] for path, library_size, name in samples])
+        return {'shard': list(shard),
+                'positions': positions,
+                'samples_total': len(samples),
+                'bam_list': hashlib.sha1(bam_list.encode()).hexdigest(),
+                'sources': {'bam_list': os.path.abspath(options.bam_list),
+                            'faidx': os.path.abspath(options.faidx),
+                            'faidx_size': stat.st_size,
+                            'faidx_mtime': stat.st_mtime_ns,
+                            'features_list': (os.path.abspath(options.features_list)
+                                              if getattr(options, 'features_list', None) else None)},
+                'options': {'merge': options.merge,
+                            'separator': options.separator,
+                            'genome': options.genome,
+                            'genome_name': reference if options.genome else None,
+                            'mapQ': int(options.mapQ),
+                            'id_cutoff': float(options.id_cutoff),
+                            'samtools': options.samtools,
+                            'fast_index': getattr(options, 'fast_index', False),
+                            'coverage': getattr(options, 'coverage', False),
+                            'features_list': bool(getattr(options, 'features_list', None)),
+                            'discard_library_size_normalisation': options.discard_library_size_normalisation}}
+
+    def merge(self, options):
+        """Merge the shard stores of mm_features --shard into features matrices"""
 
+        make_sure_path_exists(options.output_dir)
+        with self.metrics.stage('features_matrices_read') :
+            parts = []
+            for store in options.shard_stores :
+                check_file_exists(store)
+                parts.append((store, AbundanceMatrices.load(store)))
+
+        first_store, first = parts[0]
+        parameters = lambda m: (m.feature_normalisation, m.feature_size_normalisation,
+                                m.discard_feature_length_normalisation, m.library_size_normalisation)
+        shards = {}
+        for store, part in parts :
+            metadata = part.metadata
+            if 'shard' not in metadata :
+                self.logger.error('%s is not a mm_features --shard store' % store)
+                sys.exit(1)
+            for key in ('options', 'samples_total', 'bam_list') :
+                if metadata[key] != first.metadata[key] :
+                    if key == 'options' :
+                        differ = sorted(option for option in set(metadata[key]) | set(first.metadata[key])
+                                        if metadata[key].get(option) != first.metadata[key].get(option))
+                        key = 'options: ' + ', '.join(differ)
+                    self.logger.error('%s and %s were not computed with the same %s' % (first_store, store, key))
+                    sys.exit(1)
+            if metadata['shard'][1] != first.metadata['shard'][1] or parameters(part) != parameters(first) :
+                self.logger.error('%s and %s were not computed with the same options' % (first_store, store))
+                sys.exit(1)
+            if part.features != first.features or not np.array_equal(part.sizes, first.sizes) :
+                self.logger.error('%s and %s do not have the same features' % (first_store, store))
+                sys.exit(1)
+            if metadata['shard'][0] in shards :
+                self.logger.error('Shard %d/%d given twice: %s and %s' % (metadata['shard'][0], metadata['shard'][1],
+                                                                         shards[metadata['shard'][0]], store))
+                sys.exit(1)
+            shards[metadata['shard'][0]] = store
+        missing = [str(i) for i in range(1, first.metadata['shard'][1] + 1) if i not in shards]
+        if missing :
+            self.logger.error('Missing shard(s) %s of %d' % (', '.join(missing), first.metadata['shard'][1]))
+            sys.exit(1)
 
-    def annoted_features(self,options):
-        """Making annoted features matrix"""
+        total = first.metadata['samples_total']
+        self.logger.info('Merge %d shard(s) of %d sample(s)' % (len(parts), total))
+        samples = [None] * total
+        library_sizes = np.zeros(total, dtype=np.int64)
+        with_bases = all(part.bases is not None for store, part in parts)
+        with_coverage = all(part.covered is not None for store, part in parts)
+        counts = FeaturesCounts(options, len(first.features), total, with_bases, with_coverage)
+        for store, part in parts :
+            for j, i in enumerate(part.metadata['positions']) :
+                samples[i] = part.samples[j]
+                library_sizes[i] = part.library_sizes[j]
+                counts.set(i, part.column(part.reads, j),
+                           part.column(part.bases, j) if with_bases else None,
+                           part.column(part.covered, j) if with_coverage else None,
+                           part.column(part.depth, j) if with_coverage else None)
+
+        reads, bases, covered, depth = counts.matrices(('reads', 'bases', 'covered', 'depth'))
+        matrices = AbundanceMatrices(first.features, first.sizes, samples, reads, bases, library_sizes,
+                                     *parameters(first), covered=covered, depth=depth)
+        if options.max_memory :
+            matrices.set_max_memory(options.max_memory * 1024 * 1024)
+        self.write_features(options, matrices)
+        return matrices
+
+
+    def read_features_matrix(self, input_matrix):
+        """Read features, samples and values of a features abundance matrix"""
+
+        features_names = []
+        def lines(f):
+            for line in f :
+                features_names.append(line.split('\t', 1)[0])
+                yield line
+
+        with open_matrix(input_matrix) as f:
+            samples = f.readline().rstrip('\n').split('\t')[2:]
+            values = np.loadtxt(lines(f), delimiter='\t', ndmin=2,
+                                usecols=range(2, 2 + len(samples)))
+
+        return features_names, samples, values.reshape(len(features_names), len(samples))
+
+    def features_matrices(self, options, matrices=None):
+        """Yield (file name, features, samples, blocks) of the features abundance matrices.
+
+        blocks yields (rows, values) parts of the matrix. Matrices are
+        derived from the given AbundanceMatrices, or from the npz store of
+        the features directory when it exists and is newer than the
+        tabular matrices.
+        """
+
+        store = os.path.join(options.features_dir, DefaultValues.FEATURES_STORE_FILE)
+        tabular = find_matrix(os.path.join(options.features_dir, DefaultValues.FEATURES_ABUNDANCE_FILES[0]))
+        if matrices is None and os.path.exists(store) and (not os.path.exists(tabular) or os.path.getmtime(store) >= os.path.getmtime(tabular)) :
+            self.logger.info('Read features counts from %s' % store)
+            with self.metrics.stage('features_matrices_read') :
+                matrices = AbundanceMatrices.load(store)
+
+        def blocks(matrix):
+            for rows in matrices.row_blocks() :
+                with self.metrics.stage('normalisation') :
+                    values = matrix(rows)
+                yield rows, values
+
+        if matrices is not None :
+            for filename, description, matrix in matrices.matrices() :
+                if filename in DefaultValues.FEATURES_ABUNDANCE_FILES :
+                    yield filename, matrices.features, matrices.samples, blocks(matrix)
+            return
+
+        for filename in DefaultValues.FEATURES_ABUNDANCE_FILES :
+            input_matrix = find_matrix(os.path.join(options.features_dir,filename))
+            if filename.startswith('features_base') and not os.path.exists(input_matrix) :
+                self.logger.warning('%s not found, base matrices are not annotated (mm_features --fast_index)' % input_matrix)
+                return
+            check_file_exists(input_matrix)
+            with self.metrics.stage('features_matrices_read') :
+                features_names, samples, values = self.read_features_matrix(input_matrix)
+            yield filename, features_names, samples, [(slice(None), values)]
 
-        missing = []
+    def annoted_features(self,options,matrices=None):
+        """Making annoted features matrix.
 
-        features2annotation = {}
-        with open(options.features_annotation) as f:
-            for line in f: 
-                line = line.rstrip()
-                features_id,annotation = line.split('\t')
-                features2annotation[features_id] = annotation
-        
-        counts = {}
-        id2description = {}
-        annotation_id_list = []
-        with open(options.annotation_description) as f:
-            for line in f:
-                line = line.rstrip()
-                annotation_id,description = line.split('\t')
-                id2description[annotation_id] = description                
-                annotation_id_list.append(annotation_id) 
-                counts[annotation_id] = {} 
+        In-memory features matrices returned by features() can be given
+        instead of reading them back from the features directory. Each
+        --rollup level is aggregated from the matrix of the level below.
+        """
 
-        
-        annotation_id_list.append('hypothetical protein')
-        counts['hypothetical protein'] = {} 
+        with self.metrics.stage('annotation_load') :
+            annotations = self.annotation_index(options)
+            levels = self.rollup_indexes(options, annotations)
 
         check_dir_exists(options.features_dir)        
-        input_matrices = DefaultValues.FEATURES_ABUNDANCE_FILES
         output_matrices = DefaultValues.ANNOTATE_ABUNDANCE_FILES
 
-        for index,input_matrix in enumerate(input_matrices) : 
+        for input_matrix,features_names,samples,blocks in self.features_matrices(options, matrices) : 
 
-            input_matrix = os.path.join(options.features_dir,input_matrix)
             count_type,abundance_type = input_matrix.split('_')[1:3]
-            check_file_exists(input_matrix)
-            counts_all = {}
-            header = []
-            
-            with open(input_matrix) as f:
-                for line in f:
-                    line = line.rstrip()
-                    line_list = line.split('\t')
-                    if len(header) == 0 :
-                        header=line_list
-                        for i in range(3,len(header),1) :
-                            sample = header[i]
-                            for annotation_id in annotation_id_list :
-                                counts[annotation_id][sample] = 0
-                            counts_all[sample] = 0 
-
-                    else :
-                        features = line_list[0]
-                        annotation_id = features2annotation[features]
-                        if annotation_id not in counts :
-                            if annotation_id not in missing :
-                                self.logger.warning("'%s' not present in %s" % (annotation_id,options.annotation_description))
-                                missing.append(annotation_id)
-                            continue
-                        for i in range(3,len(header),1) :
-                            sample = header[i]
-                            counts[annotation_id][sample] = counts[annotation_id][sample] + float(line_list[i])
-                            counts_all[sample] = counts_all[sample] + float(line_list[i])
-            
-            output_matrix = os.path.join(options.features_dir,output_matrices[index])
-            self.logger.info('Print %s %s abundance matrix in "%s"' % (count_type, abundance_type, output_matrix))
-            output_handle = open(output_matrix, "w")
-            output_handle.write('\t'.join(['Features'] + header[3:len(header)])+'\n')
-            for annotation in annotation_id_list :
-                if sum([counts[annotation][s] for s in counts[annotation]]) == 0 and options.removed :
-                    continue
-                else :
-                    output_handle.write('\t'.join([annotation] + [str(counts[annotation][s]) for s in counts[annotation]]) + '\n' )           
+            counts = np.zeros((len(annotations), len(samples)))
+            for rows, values in blocks :
+                with self.metrics.stage('annotation_aggregate') :
+                    counts += annotations.aggregate(features_names, values, rows)
+            output_name = output_matrices[DefaultValues.FEATURES_ABUNDANCE_FILES.index(input_matrix)]
+
+            for level, index in enumerate([annotations] + levels, 1) :
+                if level > 1 :
+                    with self.metrics.stage('annotation_rollup') :
+                        counts = index.aggregate(counts)
+                rows = np.arange(len(index))
+                if options.removed :
+                    rows = np.flatnonzero(counts.sum(axis=1) != 0)
+
+                output_matrix = os.path.join(options.features_dir, output_name if level == 1 else
+                                             DefaultValues.ROLLUP_FILE_PREFIX % level + output_name)
+                self.logger.info('Print %s %s abundance matrix in "%s"' % (count_type, abundance_type, output_matrix))
+                with self.metrics.stage('annotation_write') :
+                    writer = MatrixWriter(output_matrix, ['Features'] + list(samples), index.names,
+                                          precision=getattr(options, 'precision', None),
+                                          compress=getattr(options, 'compress', None))
+                    writer.write(rows, counts[rows])
+                    writer.close()
         
         self.logger.info('Printing matrices done')
 
+    def read_names(self, names, names_file):
+        """Names given on the command line followed by the first column of names_file"""
+
+        if names is None and names_file is None :
+            return None
+        names = list(names or [])
+        if names_file :
+            check_file_exists(names_file)
+            with open(names_file) as f:
+                names.extend(line.rstrip('\n').split('\t')[0] for line in f if line.strip())
+        return names
+
+    def query(self, options):
+        """Write selected rows and samples of a tabular matrix"""
+
+        check_file_exists(options.matrix)
+        rows = self.read_names(options.rows, options.rows_file)
+        samples = self.read_names(options.samples, options.samples_file)
+        lines, missing_rows, missing_samples = query_matrix(options.matrix, rows, samples)
+        for kind, missing in (('rows', missing_rows), ('samples', missing_samples)) :
+            if missing :
+                self.logger.warning('%d %s not found in %s: %s%s' % (len(missing), kind, options.matrix,
+                                    ', '.join(missing[:10]), ' ...' if len(missing) > 10 else ''))
+
+        output_handle = open(options.output, 'w') if options.output else sys.stdout
+        try:
+            for fields in lines :
+                output_handle.write('\t'.join(fields) + '\n')
+        finally:
+            if options.output :
+                output_handle.close()
+
     def parse_options(self, options):
         """Parse user options and call the correct pipeline(s)"""
 
+        if getattr(options, 'compress', None) == 'zstd' and zstandard is None :
+            self.logger.error('The zstandard python module is required for --compress zstd')
+            sys.exit(1)
+
         if(options.subparser_name == 'mm_features'):
             self.features(options)
-        elif(options.subparser_name == 'mm_annoted_features'):
+        elif(options.subparser_name == 'mm_annotated_features'):
             self.annoted_features(options)
+        elif(options.subparser_name == 'mm_merge'):
+            self.merge(options)
+        elif(options.subparser_name == 'query'):
+            self.query(options)
         elif(options.subparser_name == 'mm_wf'):
             options.features_dir = options.output_dir
 
-            self.features(options)
-            self.annoted_features(options)
+            matrices = self.features(options)
+            self.annoted_features(options, matrices)
         else:
             self.logger.error('Unknown bamtk command: ' + options.subparser_name + '\n')
             sys.exit(1)
 
+        if getattr(options, 'metrics', None) :
+            self.logger.info('Write run metrics in %s' % options.metrics)
+            self.metrics.write(options.metrics, options.subparser_name)
+
         return 0
@@ -0,0 +1,737 @@
+#########################################################################################
+#                                                                                       #
+#   matrix.py - features abundance matrices                                             #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import gzip
+import json
+import queue
+import logging
+import threading
+import zipfile
+
+from itertools import chain
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from bamtk.defaultValues import DefaultValues
+from bamtk.metrics import Metrics
+
+# rows formatted at once when writing a matrix
+ROWS_BLOCK = 10000
+
+# suffix of the matrix files written with --compress
+COMPRESS_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+# sidecar row index of an uncompressed tabular matrix
+ROW_INDEX_SUFFIX = '.rows.npz'
+ROW_INDEX_VERSION = 2
+
+# formatted row blocks waiting for the background writer thread
+WRITE_QUEUE_SIZE = 4
+
+# int64 counts and float64 temporaries held per cell while deriving a block
+BLOCK_COPIES = 6
+
+# matrices whose empty cells are written as 0 rather than 0.0, as they
+# always have been
+INTEGER_ZEROS_FILES = (DefaultValues.FEATURES_ABUNDANCE_FILES[0], DefaultValues.FEATURES_ABUNDANCE_FILES[3])
+
+
+class AbundanceMatrices():
+    """Raw and normalised abundance matrices of features x samples counts.
+
+    reads and bases hold the raw number of reads and matched bases of each
+    feature (rows) in each sample (columns). Every other matrix is derived
+    from them on request. bases is None when only reads were counted, base
+    matrices are then left out. covered and depth, the covered bases and
+    summed depth of each feature, give the coverage matrices when present.
+    """
+
+    def __init__(self, features, sizes, samples, reads, bases, library_sizes,
+                 feature_normalisation=1000000,
+                 feature_size_normalisation=1000,
+                 discard_feature_length_normalisation=False,
+                 library_size_normalisation='total',
+                 covered=None, depth=None):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.features = features
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.samples = samples
+        self.reads = reads
+        self.bases = bases
+        self.covered = covered
+        self.depth = depth
+        self.library_sizes = np.asarray(library_sizes, dtype=np.int64)
+        self.feature_normalisation = feature_normalisation
+        self.feature_size_normalisation = feature_size_normalisation
+        self.discard_feature_length_normalisation = discard_feature_length_normalisation
+        self.library_size_normalisation = library_size_normalisation
+        self.block_rows = len(features) or 1
+        # provenance of the counts, saved in npz stores
+        self.metadata = {}
+        self._totals = None
+
+    @classmethod
+    def load(cls, store, mmap=True):
+        """Load matrices from a store written by save(), memory-mapping the counts"""
+
+        data = load_npz(store, mmap_mode='r' if mmap else None)
+        shape = (len(data['features']), len(data['samples']))
+        counts = []
+        for name in ('reads', 'bases', 'covered', 'depth'):
+            if name in data:
+                counts.append(data[name])
+            elif name + '_data' not in data:
+                counts.append(None)
+            else:
+                counts.append(SparseMatrix(data[name + '_rows'], data[name + '_cols'],
+                                           data[name + '_data'], shape))
+        matrices = cls(data['features'].tolist(), data['sizes'], data['samples'].tolist(),
+                       counts[0], counts[1], data['library_sizes'],
+                       int(data['feature_normalisation']),
+                       int(data['feature_size_normalisation']),
+                       bool(data['discard_feature_length_normalisation']),
+                       str(data['library_size_normalisation']),
+                       counts[2], counts[3])
+        if 'metadata' in data:
+            matrices.metadata = json.loads(str(data['metadata']))
+        return matrices
+
+    def save(self, store):
+        """Write features, samples, raw counts and metadata in a single npz store"""
+
+        counts = {}
+        for name, values in (('reads', self.reads), ('bases', self.bases),
+                             ('covered', self.covered), ('depth', self.depth)):
+            if values is None:
+                continue
+            if isinstance(values, SparseMatrix):
+                counts[name + '_rows'] = values.rows
+                counts[name + '_cols'] = values.cols
+                counts[name + '_data'] = values.data
+            else:
+                counts[name] = values
+
+        with open(store, 'wb') as output_handle:
+            np.savez(output_handle,
+                     features=np.array(self.features, dtype=str),
+                     sizes=self.sizes,
+                     samples=np.array(self.samples, dtype=str),
+                     library_sizes=self.library_sizes,
+                     feature_normalisation=self.feature_normalisation,
+                     feature_size_normalisation=self.feature_size_normalisation,
+                     discard_feature_length_normalisation=self.discard_feature_length_normalisation,
+                     library_size_normalisation=self.library_size_normalisation,
+                     metadata=json.dumps(self.metadata),
+                     **counts)
+
+    @staticmethod
+    def column(values, j):
+        """Dense j-th sample column of a counts matrix"""
+
+        if isinstance(values, SparseMatrix):
+            keep = values.cols == j
+            column = np.zeros(values.shape[0], dtype=values.data.dtype)
+            column[values.rows[keep]] = values.data[keep]
+            return column
+        return np.asarray(values[:, j])
+
+    def set_max_memory(self, max_memory):
+        """Derive and write matrices by row blocks using about max_memory bytes"""
+
+        row_size = max(1, len(self.samples)) * 8 * BLOCK_COPIES
+        self.block_rows = max(1, int(max_memory) // row_size)
+
+    def row_blocks(self, block_rows=None):
+        block_rows = block_rows or self.block_rows
+        for start in range(0, len(self.features), block_rows):
+            yield slice(start, min(start + block_rows, len(self.features)))
+
+    def totals(self):
+        """Per sample sums of rpk, reads abundance and base abundance"""
+
+        if self._totals is None:
+            rpk = np.zeros(len(self.samples))
+            reads = np.zeros(len(self.samples))
+            bases = np.zeros(len(self.samples))
+            for rows in self.row_blocks():
+                rpk = _add_rows(rpk, self.rpk(rows))
+                reads = _add_rows(reads, self.reads_abundance(rows))
+                if self.bases is not None:
+                    bases = _add_rows(bases, self.base_abundance(rows))
+            self._totals = (rpk, reads, bases)
+        return self._totals
+
+    def present(self):
+        """Mask of the features with at least one read in a sample"""
+
+        mask = np.zeros(len(self.features), dtype=bool)
+        for rows in self.row_blocks():
+            mask[rows] = self.reads[rows].sum(axis=1) != 0
+        return mask
+
+    def reads_count(self, rows=slice(None)):
+        """Raw reads count"""
+        return self.reads[rows]
+
+    def rpk(self, rows=slice(None)):
+        """Reads per kilobase"""
+        return self.reads[rows] * (1 / self.sizes[rows, None]) * 1000
+
+    def tpm(self, rows=slice(None)):
+        """Transcripts per million"""
+        return _per_total(self.rpk(rows) * 1000000, self.totals()[0])
+
+    def reads_abundance(self, rows=slice(None)):
+        """Reads count, normalised by feature length unless discarded"""
+        if self.discard_feature_length_normalisation:
+            return self.reads[rows]
+        return self.reads[rows] * (1 / self.sizes[rows, None]) * self.feature_size_normalisation
+
+    def base_abundance(self, rows=slice(None)):
+        """Matched bases count, normalised by feature length unless discarded"""
+        if self.discard_feature_length_normalisation:
+            return self.bases[rows]
+        return (self.bases[rows] / self.sizes[rows, None]) * self.feature_size_normalisation
+
+    def library_size(self):
+        """Library size of each sample used by the normalised matrices"""
+        if self.library_size_normalisation == 'aligned':
+            library_sizes = self.totals()[1].astype(np.int64)
+        else:
+            library_sizes = self.library_sizes.copy()
+        library_sizes[library_sizes == 0] = 1
+        return library_sizes
+
+    def reads_normalised(self, rows=slice(None)):
+        return (self.reads_abundance(rows) / self.library_size()) * self.feature_normalisation
+
+    def reads_relative(self, rows=slice(None)):
+        return _per_total(self.reads_abundance(rows), self.totals()[1])
+
+    def base_normalised(self, rows=slice(None)):
+        return (self.base_abundance(rows) / self.library_size()) * self.feature_normalisation
+
+    def base_relative(self, rows=slice(None)):
+        return _per_total(self.base_abundance(rows), self.totals()[2])
+
+    def breadth(self, rows=slice(None)):
+        """Fraction of the feature bases covered by at least one read"""
+        return self.covered[rows] * (1 / self.sizes[rows, None])
+
+    def mean_depth(self, rows=slice(None)):
+        """Mean number of reads covering a base of the feature"""
+        return self.depth[rows] * (1 / self.sizes[rows, None])
+
+    def matrices(self):
+        """(file name, description, method) of every features matrix"""
+
+        matrices = [(DefaultValues.FEATURES_COUNT_FILE, 'raw reads count', self.reads_count),
+                    (DefaultValues.FEATURES_TPM_FILE, 'TPM', self.tpm),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[0], 'raw reads abundance', self.reads_abundance),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[1], 'normalised reads abundance', self.reads_normalised),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[2], 'relative reads abundance', self.reads_relative),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[3], 'raw base abundance', self.base_abundance),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[4], 'normalised base abundance', self.base_normalised),
+                    (DefaultValues.FEATURES_ABUNDANCE_FILES[5], 'relative base abundance', self.base_relative)]
+        if self.bases is None:
+            matrices = matrices[:5]
+        if self.covered is not None:
+            matrices += [(DefaultValues.FEATURES_BREADTH_FILE, 'breadth of coverage', self.breadth),
+                         (DefaultValues.FEATURES_DEPTH_FILE, 'mean depth of coverage', self.mean_depth)]
+        return matrices
+
+    def write(self, output_dir, removed=False, metrics=None, precision=None, compress=None):
+        """Write every features matrix in tabular format.
+
+        Time spent deriving and writing the matrices is added to the
+        'normalisation' and 'matrix_write' stages of metrics when given.
+        """
+
+        metrics = metrics or Metrics()
+        with metrics.stage('normalisation'):
+            keep = self.present() if removed else None
+        for filename, description, matrix in self.matrices():
+            output_file = os.path.join(output_dir, filename)
+            self.logger.info('Print %s matrix in %s' % (description, output_file))
+            writer = MatrixWriter(output_file, ['Features', 'Features_size'] + list(self.samples),
+                                  self.features, self.sizes, precision, compress, min(self.block_rows, ROWS_BLOCK),
+                                  integer_zeros=filename in INTEGER_ZEROS_FILES)
+            for rows in self.row_blocks():
+                index = np.arange(rows.start, rows.stop)
+                with metrics.stage('normalisation'):
+                    values = matrix(rows)
+                    if keep is not None:
+                        values = values[keep[rows]]
+                        index = index[keep[rows]]
+                with metrics.stage('matrix_write'):
+                    writer.write(index, values)
+            writer.close()
+
+    def write_mtx(self, output_dir, metrics=None, precision=None, compress=None):
+        """Write every features matrix in MatrixMarket coordinate format"""
+
+        metrics = metrics or Metrics()
+        rows_file = os.path.join(output_dir, DefaultValues.FEATURES_MTX_ROWS_FILE)
+        with open(rows_file, 'w') as output_handle:
+            for feature, size in zip(self.features, self.sizes.tolist()):
+                output_handle.write('%s\t%s\n' % (feature, size))
+        columns_file = os.path.join(output_dir, DefaultValues.FEATURES_MTX_COLUMNS_FILE)
+        with open(columns_file, 'w') as output_handle:
+            output_handle.write(''.join(sample + '\n' for sample in self.samples))
+
+        for filename, description, matrix in self.matrices():
+            output_file = os.path.join(output_dir, os.path.splitext(filename)[0] + '.mtx' +
+                                       COMPRESS_SUFFIXES.get(compress, ''))
+            self.logger.info('Print %s matrix in %s' % (description, output_file))
+            with metrics.stage('normalisation'):
+                values = matrix()
+                if not isinstance(values, SparseMatrix):
+                    values = SparseMatrix.from_dense(values)
+            with metrics.stage('matrix_write'):
+                values.write_mtx(output_file, precision, compress, min(self.block_rows, ROWS_BLOCK))
+
+
+class SparseMatrix():
+    """Features x samples matrix stored as (row, column, value) coordinates.
+
+    Coordinates are sorted by row then column. Slicing rows and multiplying
+    or dividing by a scalar, a (rows, 1) column vector or a per sample
+    vector behave like the dense NumPy equivalent, so AbundanceMatrices
+    derives sparse matrices with the same expressions.
+    """
+
+    # let NumPy defer arithmetic with arrays to this class
+    __array_ufunc__ = None
+
+    def __init__(self, rows, cols, data, shape):
+        """Initialization"""
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.data = np.asarray(data)
+        self.shape = tuple(shape)
+        self.ndim = 2
+
+    @classmethod
+    def from_columns(cls, columns, shape):
+        """Build from (column, rows, values) tuples given in any order.
+
+        Values given several times for a cell are summed.
+        """
+
+        columns = [c for c in columns if len(c[1])] or [(0, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))]
+        rows = np.concatenate([c[1] for c in columns])
+        cols = np.concatenate([np.full(len(c[1]), c[0], dtype=np.int64) for c in columns])
+        data = np.concatenate([c[2] for c in columns])
+        cells, first, inverse = np.unique(rows * shape[1] + cols, return_index=True, return_inverse=True)
+        if len(cells) < len(data):
+            summed = np.zeros(len(cells), dtype=data.dtype)
+            np.add.at(summed, inverse, data)
+            return cls(rows[first], cols[first], summed, shape)
+        order = np.lexsort((cols, rows))
+        return cls(rows[order], cols[order], data[order], shape)
+
+    @classmethod
+    def from_dense(cls, values):
+        values = np.asarray(values)
+        rows, cols = np.nonzero(values)
+        return cls(rows, cols, values[rows, cols], values.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            if step == 1:
+                lo, hi = np.searchsorted(self.rows, [start, stop])
+                return SparseMatrix(self.rows[lo:hi] - start, self.cols[lo:hi], self.data[lo:hi],
+                                    (max(0, stop - start), self.shape[1]))
+            rows = np.arange(start, stop, step)
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        position = np.full(self.shape[0], -1, dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        new_rows = position[self.rows]
+        keep = new_rows >= 0
+        matrix = SparseMatrix(new_rows[keep], self.cols[keep], self.data[keep], (len(rows), self.shape[1]))
+        if len(rows) > 1 and (np.diff(rows) < 0).any():
+            order = np.lexsort((matrix.cols, matrix.rows))
+            matrix = SparseMatrix(matrix.rows[order], matrix.cols[order], matrix.data[order], matrix.shape)
+        return matrix
+
+    def _apply(self, other, op):
+        other = np.asarray(other)
+        if other.ndim == 0:
+            factors = other
+        elif other.ndim == 2 and other.shape == (self.shape[0], 1):
+            factors = other[self.rows, 0]
+        elif other.ndim == 1 and other.shape[0] == self.shape[1]:
+            factors = other[self.cols]
+        else:
+            raise ValueError('Cannot broadcast %s with a sparse %s matrix' % (other.shape, self.shape))
+        return SparseMatrix(self.rows, self.cols, op(self.data, factors), self.shape)
+
+    def __mul__(self, other):
+        return self._apply(other, np.multiply)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return self._apply(other, np.true_divide)
+
+    def sum(self, axis):
+        if axis == 0:
+            return np.bincount(self.cols, weights=self.data, minlength=self.shape[1])
+        return np.bincount(self.rows, weights=self.data, minlength=self.shape[0])
+
+    def toarray(self):
+        values = np.zeros(self.shape, dtype=self.data.dtype)
+        values[self.rows, self.cols] = self.data
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.toarray()
+        return values if dtype is None else values.astype(dtype)
+
+    def write_mtx(self, output_file, precision=None, compress=None, block_rows=ROWS_BLOCK):
+        """Write in MatrixMarket coordinate format, with 1-based indexes.
+
+        At most block_rows rows worth of entries are formatted at once.
+        """
+
+        block_size = block_rows * max(1, self.shape[1])
+        field = 'integer' if np.issubdtype(self.data.dtype, np.integer) else 'real'
+        line = '%d %d ' + value_format(self.data.dtype, precision) + '\n'
+        with open_matrix(output_file, 'wt', compress) as output_handle:
+            output_handle.write('%%%%MatrixMarket matrix coordinate %s general\n' % field)
+            output_handle.write('%d %d %d\n' % (self.shape[0], self.shape[1], len(self.data)))
+            for start in range(0, len(self.data), block_size):
+                block = slice(start, start + block_size)
+                entries = chain.from_iterable(zip((self.rows[block] + 1).tolist(),
+                                                  (self.cols[block] + 1).tolist(),
+                                                  self.data[block].tolist()))
+                output_handle.write((line * len(self.data[block])) % tuple(entries))
+
+
+class MatrixWriter():
+    """Write the rows of a features x samples matrix in tabular format.
+
+    Each block of at most block_rows rows is formatted by a single
+    string formatting operation. Blocks are written, and compressed with compress, by a
+    background thread while the next ones are derived and formatted.
+    Uncompressed matrices get a RowIndex sidecar of their rows offsets.
+    With integer_zeros, zero cells of float matrices are written as 0.
+    """
+
+    def __init__(self, output_file, header, features, sizes=None, precision=None, compress=None,
+                 block_rows=ROWS_BLOCK, integer_zeros=False):
+        """Initialization"""
+        self.features = features
+        self.sizes = sizes
+        self.precision = precision
+        self.block_rows = block_rows
+        self.integer_zeros = integer_zeros
+        self.output_file = output_file + COMPRESS_SUFFIXES.get(compress, '')
+        self.output_handle = open_matrix(self.output_file, 'wb', compress)
+        self.row_index = compress is None
+        self._names = []
+        self._offsets = []
+        self._position = 0
+        self._error = None
+        self._queue = queue.Queue(WRITE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._write_queued, daemon=True)
+        self._thread.start()
+        self._put('\t'.join(header) + '\n')
+
+    def _write_queued(self):
+        while True:
+            text = self._queue.get()
+            if text is None:
+                return
+            if self._error is None:
+                try:
+                    data = text.encode()
+                    if self.row_index:
+                        starts = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)[:-1] + 1
+                        self._offsets.append(self._position)
+                        self._offsets.extend((starts + self._position).tolist())
+                    self.output_handle.write(data)
+                    self._position += len(data)
+                except Exception as error:
+                    self._error = error
+
+    def _put(self, text):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(text)
+
+    def write(self, rows, values):
+        """Write the values of the given feature indexes"""
+
+        for start in range(0, len(rows), self.block_rows):
+            block = rows[start:start + self.block_rows]
+            block_values = np.asarray(values[start:start + self.block_rows])
+            columns = [[self.features[i] for i in block.tolist()]]
+            if self.row_index:
+                self._names.extend(columns[0])
+            line = '%s'
+            if self.sizes is not None:
+                columns.append(self.sizes[block].tolist())
+                line += '\t%d'
+            if self.integer_zeros and np.issubdtype(block_values.dtype, np.floating):
+                cells = block_values.T.astype(object)
+                cells[block_values.T == 0] = 0
+                columns.extend(cells.tolist())
+            else:
+                columns.extend(block_values.T.tolist())
+            line += ('\t' + value_format(block_values.dtype, self.precision)) * block_values.shape[1] + '\n'
+            self._put((line * len(block)) % tuple(chain.from_iterable(zip(*columns))))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.output_handle.close()
+        if self._error is not None:
+            raise self._error
+        if self.row_index:
+            # the first offset is the one of the header
+            RowIndex.build(self._names, self._offsets[1:]).save(self.output_file + ROW_INDEX_SUFFIX,
+                                                                RowIndex.stamp(self.output_file))
+
+
+class RowIndex():
+    """Byte offset of each row of a tabular matrix.
+
+    Row names are sorted so that rows are found by binary search in the
+    memory-mapped index, without reading the matrix or the whole index.
+    The index is up to date while the size and modification time of the
+    matrix are the ones of its matrix_stamp.
+    """
+
+    def __init__(self, names, offsets, matrix_stamp=None):
+        """Initialization"""
+        self.names = names
+        self.offsets = offsets
+        self.matrix_stamp = matrix_stamp
+
+    @classmethod
+    def build(cls, names, offsets):
+        names = np.array([name.encode() for name in names], dtype=np.bytes_)
+        order = np.argsort(names, kind='stable')
+        return cls(names[order], np.asarray(offsets, dtype=np.int64)[order])
+
+    @staticmethod
+    def stamp(matrix):
+        stat = os.stat(matrix)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def save(self, path, matrix_stamp):
+        with open(path, 'wb') as output_handle:
+            np.savez(output_handle, names=self.names, offsets=self.offsets,
+                     matrix_stamp=np.array(matrix_stamp, dtype=np.int64), version=ROW_INDEX_VERSION)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load the index of a matrix, None when it is missing or of another version"""
+
+        if not os.path.exists(path):
+            return None
+        data = load_npz(path, mmap_mode='r' if mmap else None)
+        if int(data['version']) != ROW_INDEX_VERSION:
+            return None
+        return cls(data['names'], data['offsets'], data['matrix_stamp'].tolist())
+
+    def lookup(self, names):
+        """Offset of the row of each name, -1 when the matrix has no such row"""
+
+        keys = np.array([name.encode() for name in names], dtype=np.bytes_)
+        if not len(self.names):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.names, keys), len(self.names) - 1)
+        return np.where(self.names[positions] == keys, self.offsets[positions], -1)
+
+
+def query_matrix(input_matrix, rows=None, samples=None):
+    """Select rows and sample columns of a tabular matrix.
+
+    rows are read by seeking to their offset in the RowIndex of the
+    matrix, or by scanning it when it has no up to date index. Rows
+    missing from the matrix are skipped. samples restricts the columns
+    to the row name, its size when present, and the given samples.
+    Returns (lines, missing_rows, missing_samples) where lines yields
+    the header then each selected row as a list of fields.
+    """
+
+    index = None
+    if rows is not None:
+        index = RowIndex.load(input_matrix + ROW_INDEX_SUFFIX)
+        if index is not None and index.matrix_stamp != RowIndex.stamp(input_matrix):
+            index = None
+        if index is None:
+            logging.getLogger('timestamp').warning('No up to date row index for %s, scanning the matrix' % input_matrix)
+
+    with open_matrix(input_matrix) as f:
+        header = f.readline().rstrip('\n').split('\t')
+    first = 2 if header[1:2] == ['Features_size'] else 1
+    columns = list(range(len(header)))
+    missing_samples = []
+    if samples is not None:
+        positions = {name: j for j, name in enumerate(header[first:], first)}
+        missing_samples = [name for name in samples if name not in positions]
+        columns = list(range(first)) + [positions[name] for name in samples if name in positions]
+
+    if rows is None:
+        selected, missing_rows = None, []
+    elif index is not None:
+        offsets = index.lookup(rows)
+        selected = offsets[offsets >= 0].tolist()
+        missing_rows = [name for name, offset in zip(rows, offsets.tolist()) if offset < 0]
+    else:
+        selected = {}
+        with open_matrix(input_matrix) as f:
+            f.readline()
+            wanted = set(rows)
+            for line in f:
+                name = line.split('\t', 1)[0]
+                if name in wanted:
+                    selected[name] = line
+        missing_rows = [name for name in rows if name not in selected]
+        selected = [selected[name] for name in rows if name in selected]
+
+    def lines():
+        yield [header[j] for j in columns]
+        if selected is not None and index is not None:
+            with open(input_matrix, 'rb') as f:
+                for offset in selected:
+                    f.seek(offset)
+                    fields = f.readline().decode().rstrip('\n').split('\t')
+                    yield [fields[j] for j in columns]
+        elif selected is not None:
+            for line in selected:
+                fields = line.rstrip('\n').split('\t')
+                yield [fields[j] for j in columns]
+        else:
+            with open_matrix(input_matrix) as f:
+                f.readline()
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    yield [fields[j] for j in columns]
+
+    return lines(), missing_rows, missing_samples
+
+
+def value_format(dtype, precision=None):
+    """printf format of matrix values: shortest repr, or precision significant digits"""
+
+    if np.issubdtype(dtype, np.integer):
+        return '%d'
+    if precision is None:
+        return '%r'
+    return '%%.%dg' % precision
+
+
+def open_matrix(path, mode='rt', compress=None):
+    """Open a matrix file, compressed by compress or according to its suffix"""
+
+    if compress is None:
+        for name, suffix in COMPRESS_SUFFIXES.items():
+            if path.endswith(suffix):
+                compress = name
+    if compress == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    if compress == 'zstd':
+        if zstandard is None:
+            raise ImportError('the zstandard module is required for zstd compressed matrices')
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def find_matrix(path):
+    """Path of a matrix file as written, with or without compression"""
+
+    for suffix in ('',) + tuple(COMPRESS_SUFFIXES.values()):
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+
+def load_npz(path, mmap_mode=None):
+    """Load the arrays of an uncompressed npz file.
+
+    Contrary to numpy.load(), arrays are memory-mapped when mmap_mode is
+    given since np.savez stores them without compression.
+    """
+
+    if mmap_mode is None:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('%s is compressed and cannot be memory-mapped' % path)
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if len(shape) == 0 or 0 in shape:
+                count = int(np.prod(shape))
+                arrays[name] = np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype).reshape(shape)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                                         shape=shape, order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+def _add_rows(totals, values):
+    """Add the rows of a block one after the other to the per sample totals.
+
+    The rows are added in the same order whatever the block size and memory
+    layout, so the totals of a --max_memory run are byte-identical to the
+    in-memory ones.
+    """
+
+    if isinstance(values, SparseMatrix):
+        columns = np.concatenate([np.arange(len(totals)), values.cols])
+        return np.bincount(columns, weights=np.concatenate([totals, values.data]), minlength=len(totals))
+    return np.cumsum(np.vstack([totals, values]), axis=0)[-1]
+
+
+def _per_total(values, totals):
+    """Divide each column by its total, columns summing to zero stay zero"""
+
+    return values / np.where(totals == 0, 1, totals)
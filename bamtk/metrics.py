@@ -0,0 +1,99 @@
+#########################################################################################
+#                                                                                       #
+#   metrics.py - run time metrics report                                                #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import json
+import time
+
+from contextlib import contextmanager
+
+# per sample counters summed over the parts of a sample counted separately
+SAMPLE_COUNTERS = ('records', 'unplaced', 'mapq_filtered', 'id_filtered', 'counted',
+                   'bytes_read', 'bytes_inflated', 'inflate_seconds', 'decode_seconds',
+                   'count_seconds', 'cpu_seconds')
+
+
+class Metrics():
+    """Wall and CPU time of each stage of a run and counters of each sample"""
+
+    def __init__(self):
+        """Initialization"""
+        self.stages = {}
+        self.samples = []
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        """Add the wall and CPU time of the enclosed block to a stage"""
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add(self, name, wall, cpu):
+        times = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+        times['wall_seconds'] += wall
+        times['cpu_seconds'] += cpu
+        times['calls'] += 1
+
+    def sample(self, name, alignment_file, stats, wall=None, cached=False):
+        """Record the counters of a sample.
+
+        stats is a list of the stats dictionaries returned by
+        count_alignments() for each part of the sample. wall defaults to
+        the elapsed time between the start of its first part and the end
+        of its last one, parts being counted in parallel.
+        """
+
+        entry = {'sample': name, 'alignment_file': alignment_file, 'cached': cached}
+        for counter in SAMPLE_COUNTERS:
+            values = [part.get(counter) for part in stats]
+            entry[counter] = None if not values or None in values else sum(values)
+        if wall is None and stats:
+            if all('started' in part for part in stats):
+                wall = (max(part['started'] + part['wall_seconds'] for part in stats)
+                        - min(part['started'] for part in stats))
+            else:
+                wall = max(part['wall_seconds'] for part in stats)
+        entry['wall_seconds'] = wall
+        entry['parts'] = len(stats)
+        if wall and entry['records']:
+            entry['records_per_second'] = entry['records'] / wall
+        else:
+            entry['records_per_second'] = None
+        self.samples.append(entry)
+
+    def report(self, command=None):
+        return {'command': command,
+                'wall_seconds': time.perf_counter() - self._wall,
+                'cpu_seconds': time.process_time() - self._cpu,
+                'stages': self.stages,
+                'samples': self.samples}
+
+    def write(self, path, command=None):
+        """Write the metrics in JSON format"""
+
+        with open(path, 'w') as output_handle:
+            json.dump(self.report(command), output_handle, indent=2)
+            output_handle.write('\n')
@@ -0,0 +1,197 @@
+#########################################################################################
+#                                                                                       #
+#   server.py - persistent bamtk worker on a Unix socket                                #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+import os
+import io
+import json
+import time
+import socket
+import logging
+import tempfile
+import traceback
+import socketserver
+
+from collections import OrderedDict
+from contextlib import redirect_stderr, redirect_stdout
+
+from biolib.common import make_sure_path_exists
+
+from bamtk.main import OptionsParser
+
+# commands a server accepts
+SERVER_COMMANDS = ('mm_features', 'mm_annotated_features', 'mm_wf', 'mm_merge')
+
+
+def default_socket():
+    """Per user socket path used when --socket is not given"""
+
+    return os.path.join(tempfile.gettempdir(), 'bamtk-%d.sock' % os.getuid())
+
+
+class IndexCache():
+    """Least recently used cache of parsed reference and annotation indexes.
+
+    An entry is valid as long as the files it was built from keep the
+    same size and modification time, otherwise it is rebuilt.
+    """
+
+    def __init__(self, maxsize=8):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, paths, build):
+        """Cached value of key, built by build() when missing or stale"""
+
+        stamp = tuple((os.path.abspath(path), os.stat(path).st_mtime_ns, os.stat(path).st_size)
+                      for path in paths)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.logger.info('Reuse cached %s index' % key[0])
+            return entry[1]
+
+        self.misses += 1
+        value = build()
+        self.entries[key] = (stamp, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+
+class BamtkServer(socketserver.UnixStreamServer):
+    """Run bamtk jobs received on a Unix socket, one at a time.
+
+    A request is one JSON line {"argv": [...], "cwd": "..."} answered by
+    one JSON line {"status": 0 or 1, "error": ..., "seconds": ...}.
+    Jobs are run sequentially in the server process, parallelism inside
+    a job still comes from --jobs.
+    """
+
+    def __init__(self, socket_path, parser, cache_size=8):
+        """Initialization"""
+        self.logger = logging.getLogger('timestamp')
+        self.socket_path = socket_path
+        self.parser = parser
+        self.index_cache = IndexCache(cache_size)
+        self.jobs = 0
+        self.stopped = False
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        make_sure_path_exists(os.path.dirname(os.path.abspath(socket_path)))
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+    def run_job(self, argv, cwd):
+        """Parse and run one bamtk command line, return (status, error)"""
+
+        errors = io.StringIO()
+        try:
+            with redirect_stderr(errors), redirect_stdout(errors):
+                options = self.parser.parse_args(argv)
+        except SystemExit:
+            return 1, errors.getvalue().strip()
+        if options.subparser_name not in SERVER_COMMANDS:
+            return 1, 'bamtk serve only runs %s jobs' % ', '.join(SERVER_COMMANDS)
+
+        handler = None
+        previous = os.getcwd()
+        try:
+            os.chdir(cwd)
+            log_dir = getattr(options, 'output_dir', None) or options.features_dir
+            make_sure_path_exists(log_dir)
+            handler = logging.FileHandler(os.path.join(log_dir, 'bamtk.log'), 'a')
+            handler.setFormatter(logging.Formatter(fmt="[%(asctime)s] %(levelname)s: %(message)s",
+                                                   datefmt="%Y-%m-%d %H:%M:%S"))
+            self.logger.addHandler(handler)
+            self.logger.info('bamtk ' + ' '.join(argv))
+            OptionsParser(self.index_cache).parse_options(options)
+        except SystemExit:
+            return 1, 'Unrecoverable error.'
+        except Exception as error:
+            self.logger.error(traceback.format_exc())
+            return 1, '%s: %s' % (type(error).__name__, error)
+        finally:
+            if handler is not None:
+                self.logger.removeHandler(handler)
+                handler.close()
+            os.chdir(previous)
+        return 0, None
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Handle one request of a BamtkServer"""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if request.get('stop'):
+            self.wfile.write(json.dumps({'status': 0, 'error': None}).encode() + b'\n')
+            self.server.logger.info('Stop requested')
+            self.server.stopped = True
+            return
+
+        start = time.perf_counter()
+        status, error = self.server.run_job(request['argv'], request['cwd'])
+        self.server.jobs += 1
+        self.server.logger.info('Job %d done in %.2f s (status %d), index cache %d hits / %d misses' % (
+            self.server.jobs, time.perf_counter() - start, status,
+            self.server.index_cache.hits, self.server.index_cache.misses))
+        self.wfile.write(json.dumps({'status': status, 'error': error,
+                                     'seconds': time.perf_counter() - start}).encode() + b'\n')
+
+
+def serve(socket_path, parser, cache_size=8):
+    """Serve bamtk jobs until a stop request is received"""
+
+    logger = logging.getLogger('timestamp')
+    server = BamtkServer(socket_path, parser, cache_size)
+    logger.info('Listening on %s' % socket_path)
+    try:
+        while not server.stopped:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    logger.info('Server stopped after %d job(s)' % server.jobs)
+
+
+def submit(socket_path, argv=None, stop=False):
+    """Send a job, or a stop request, to a bamtk server and wait for its answer"""
+
+    request = {'stop': True} if stop else {'argv': argv, 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b'\n')
+        response = client.makefile('rb').readline()
+    if not response:
+        return {'status': 1, 'error': 'No answer from the bamtk server on %s' % socket_path}
+    return json.loads(response.decode())
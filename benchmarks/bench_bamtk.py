@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+#########################################################################################
+#                                                                                       #
+#   bench_bamtk.py - synthetic inputs generator and mm_features benchmark               #
+#                                                                                       #
+#########################################################################################
+#########################################################################################
+#                                                                                       #
+#    This program is free software: you can redistribute it and/or modify               #
+#    it under the terms of the GNU General Public License as published by               #
+#    the Free Software Foundation, either version 3 of the License, or                  #
+#    (at your option) any later version.                                                #
+#                                                                                       #
+#    This program is distributed in the hope that it will be useful,                    #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of                     #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                      #
+#    GNU General Public License for more details.                                       #
+#                                                                                       #
+#    You should have received a copy of the GNU General Public License                  #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.               #
+#                                                                                       #
+#########################################################################################
+
+"""Generate synthetic faidx, BAM and annotation files and time bamtk on them.
+
+Results are written as JSON so that runs of different releases can be
+compared, e.g.:
+
+    python benchmarks/bench_bamtk.py --features 100000 --reads 2000000 \\
+        --samples 4 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import zlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from argparse import Namespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bamtk
+from bamtk.features import FeatureIndex
+from bamtk.main import OptionsParser
+
+BGZF_BLOCK_SIZE = 0xff00
+
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# CIGAR mixes: (operations, weight) with 150 bases reads
+CIGAR_MIXES = {
+    'match': [([(150, 'M')], 1)],
+    'mixed': [([(150, 'M')], 6),
+              ([(10, 'S'), (140, 'M')], 2),
+              ([(70, 'M'), (2, 'I'), (78, 'M')], 1),
+              ([(60, 'M'), (5, 'D'), (90, 'M')], 1)],
+    'clipped': [([(50, 'S'), (100, 'M')], 1),
+                ([(100, 'M'), (50, 'S')], 1),
+                ([(150, 'M')], 1)],
+}
+
+CIGAR_CODES = 'MIDNSHP=X'
+
+
+class BgzfWriter():
+    """Write BGZF blocks"""
+
+    def __init__(self, path):
+        self.handle = open(path, 'wb')
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def _block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                             len(deflated) + 25)
+        self.handle.write(header + deflated + struct.pack('<II', zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self.buffer:
+            self._block(bytes(self.buffer))
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+def generate_faidx(path, n_features, min_length, max_length, rng, contigs=1):
+    """Write a faidx of n_features features of contigs sequences each"""
+
+    names = []
+    lengths = rng.integers(min_length, max_length + 1, size=n_features * contigs)
+    with open(path, 'w') as output_handle:
+        offset = 0
+        for i in range(n_features):
+            for j in range(contigs):
+                name = 'feature%d.%d' % (i, j + 1) if contigs > 1 else 'feature%d' % i
+                length = int(lengths[i * contigs + j])
+                output_handle.write('%s\t%d\t%d\t60\t61\n' % (name, length, offset))
+                offset += length + length // 60 + 1
+                names.append((name, length))
+    return names
+
+
+def generate_bam(path, references, n_reads, cigar_mix, rng, unmapped=0.02, read_groups=0):
+    """Write a coordinate sorted BAM file of n_reads synthetic reads"""
+
+    header = '@HD\tVN:1.6\tSO:coordinate\n'
+    header += ''.join('@SQ\tSN:%s\tLN:%d\n' % reference for reference in references)
+    # read group samples are named after the BAM file to be unique across files
+    sample = os.path.splitext(os.path.basename(path))[0]
+    header += ''.join('@RG\tID:rg%d\tSM:%s_rg%d\n' % (i, sample, i) for i in range(read_groups))
+
+    writer = BgzfWriter(path)
+    data = bytearray(b'BAM\x01')
+    data += struct.pack('<i', len(header)) + header.encode()
+    data += struct.pack('<i', len(references))
+    for name, length in references:
+        data += struct.pack('<i', len(name) + 1) + name.encode() + b'\x00' + struct.pack('<i', length)
+    writer.write(data)
+
+    cigars = CIGAR_MIXES[cigar_mix]
+    weights = np.array([weight for cigar, weight in cigars], dtype=float)
+    templates = []
+    for cigar, weight in cigars:
+        l_seq = sum(length for length, op in cigar if op in 'MIS=X')
+        packed = b''.join(struct.pack('<I', length << 4 | CIGAR_CODES.index(op)) for length, op in cigar)
+        templates.append((len(cigar), l_seq, packed + bytes((l_seq + 1) // 2) + b'\xff' * l_seq))
+
+    n_unmapped = int(n_reads * unmapped)
+    n_mapped = n_reads - n_unmapped
+    lengths = np.array([length for name, length in references], dtype=np.int64)
+    ref_ids = np.sort(rng.choice(len(references), size=n_mapped, p=lengths / lengths.sum()))
+    positions = (rng.random(n_mapped) * np.maximum(lengths[ref_ids] - 150, 1)).astype(np.int64)
+    order = np.lexsort((positions, ref_ids))
+    ref_ids = ref_ids[order].tolist() + [-1] * n_unmapped
+    positions = positions[order].tolist() + [-1] * n_unmapped
+    cigar_ids = rng.choice(len(templates), size=n_reads, p=weights / weights.sum()).tolist()
+    mapqs = rng.integers(0, 61, size=n_reads).tolist()
+    groups = rng.integers(0, max(read_groups, 1), size=n_reads).tolist()
+
+    record = struct.Struct('<iiiBBHHHiiii')
+    chunk = bytearray()
+    for i in range(n_reads):
+        n_cigar, l_seq, body = templates[cigar_ids[i]]
+        read_name = b'r%d\x00' % i
+        tags = b'RGZrg%d\x00' % groups[i] if read_groups else b''
+        if ref_ids[i] < 0:
+            body = body[4 * n_cigar:]
+            n_cigar = 0
+        size = record.size - 4 + len(read_name) + len(body) + len(tags)
+        chunk += record.pack(size, ref_ids[i], positions[i], len(read_name),
+                             mapqs[i] if n_cigar else 0, 4680, n_cigar,
+                             0 if n_cigar else 4, l_seq, -1, -1, 0)
+        chunk += read_name
+        chunk += body
+        chunk += tags
+        if len(chunk) >= 1 << 20:
+            writer.write(bytes(chunk))
+            chunk.clear()
+    writer.write(bytes(chunk))
+    writer.close()
+
+
+def generate_annotation(features_annotation, annotation_description, features, n_annotations, coverage, rng):
+    """Annotate a coverage fraction of the features with n_annotations ids"""
+
+    annotated = rng.random(len(features)) < coverage
+    annotation_ids = rng.integers(0, n_annotations, size=len(features))
+    with open(features_annotation, 'w') as output_handle:
+        for feature, keep, annotation_id in zip(features, annotated.tolist(), annotation_ids.tolist()):
+            if keep:
+                output_handle.write('%s\tK%05d\n' % (feature, annotation_id))
+    with open(annotation_description, 'w') as output_handle:
+        for annotation_id in range(n_annotations):
+            output_handle.write('K%05d\tsynthetic annotation %d\n' % (annotation_id, annotation_id))
+
+
+def generate(args, workdir):
+    """Write the synthetic inputs of a benchmark in workdir"""
+
+    rng = np.random.default_rng(args.seed)
+    faidx = os.path.join(workdir, 'catalogue.fa.fai')
+    references = generate_faidx(faidx, args.features, args.min_length, args.max_length, rng, args.contigs)
+    features = sorted(set(FeatureIndex(merge=args.contigs > 1).feature_name(name) for name, length in references))
+
+    bam_list = os.path.join(workdir, 'bam_list.txt')
+    with open(bam_list, 'w') as output_handle:
+        for i in range(args.samples):
+            bam = os.path.join(workdir, 'sample_%d.bam' % (i + 1))
+            generate_bam(bam, references, args.reads, args.cigar_mix, rng, read_groups=args.read_groups)
+            output_handle.write('%s\t%d\n' % (bam, args.reads * 2))
+
+    features_annotation = os.path.join(workdir, 'features2annotation.tsv')
+    annotation_description = os.path.join(workdir, 'annotation_description.tsv')
+    generate_annotation(features_annotation, annotation_description, features,
+                        args.annotations, args.annotation_coverage, rng)
+    return faidx, bam_list, features_annotation, annotation_description
+
+
+def options(args, faidx, bam_list, features_annotation, annotation_description, output_dir):
+    """mm_wf options of a benchmark run"""
+
+    return Namespace(subparser_name='mm_wf', faidx=faidx, bam_list=bam_list,
+                     features_annotation=features_annotation,
+                     annotation_description=annotation_description,
+                     output_dir=output_dir, features_dir=output_dir,
+                     faidx_extension='.fa.fai', extension='.bam',
+                     mapQ=args.mapq, id_cutoff=args.id_cutoff, threads='2', jobs=args.jobs,
+                     samtools=args.samtools, cache=False, merge=args.contigs > 1, separator='.',
+                     genome=False, feature_normalisation=1000000, feature_size_normalisation=1000,
+                     discard_feature_length_normalisation=False,
+                     discard_library_size_normalisation=False,
+                     library_size_normalisation='total', no_feature_matrices=False,
+                     format=args.format, max_memory=args.max_memory, sparse=args.sparse,
+                     removed=False)
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)
+               if os.path.isfile(os.path.join(directory, f)) and not f.endswith('.log'))
+
+
+def peak_rss():
+    """Peak resident set size of this process and its children, in bytes.
+
+    ru_maxrss is the peak over the lifetime of the process, so each run is
+    timed in a fresh process by run_repeat().
+    """
+
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def run(args, inputs, output_dir):
+    """Time features() and annoted_features() once"""
+
+    parser = OptionsParser()
+    run_options = options(args, *inputs, output_dir)
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    parser.features(run_options)
+    features_wall, features_cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    parser.annoted_features(run_options)
+    annotation_wall, annotation_cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    metrics = parser.metrics.report()
+    records = sum(sample['records'] or 0 for sample in metrics['samples'])
+    return {'features': {'wall': features_wall, 'cpu': features_cpu},
+            'annotated_features': {'wall': annotation_wall, 'cpu': annotation_cpu},
+            'stages': metrics['stages'],
+            'samples': metrics['samples'],
+            'reads_per_second': records / features_wall if features_wall else None,
+            'peak_rss': peak_rss(),
+            'output_bytes': directory_size(output_dir)}
+
+
+def run_repeat(args, inputs, output_dir):
+    """Time run() in a fresh Python process, for its own peak RSS"""
+
+    results = output_dir + '.json'
+    spec = json.dumps({'args': vars(args), 'inputs': list(inputs), 'output_dir': output_dir, 'results': results})
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--run_repeat', spec], check=True)
+    with open(results) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bamtk mm_features and mm_annotated_features on synthetic inputs.')
+    parser.add_argument('--features', help='number of features [10000]', type=int, default=10000)
+    parser.add_argument('--contigs', help='sequences per feature, grouped with --merge when > 1 [1]', type=int, default=1)
+    parser.add_argument('--min_length', help='minimum sequence length [300]', type=int, default=300)
+    parser.add_argument('--max_length', help='maximum sequence length [3000]', type=int, default=3000)
+    parser.add_argument('--reads', help='reads per sample [200000]', type=int, default=200000)
+    parser.add_argument('--samples', help='number of samples [2]', type=int, default=2)
+    parser.add_argument('--read_groups', help='RG:Z tagged read groups per sample [0]', type=int, default=0)
+    parser.add_argument('--cigar_mix', help='CIGAR strings mix [mixed]', choices=sorted(CIGAR_MIXES), default='mixed')
+    parser.add_argument('--annotations', help='number of annotation ids [1000]', type=int, default=1000)
+    parser.add_argument('--annotation_coverage', help='fraction of annotated features [0.6]', type=float, default=0.6)
+    parser.add_argument('--mapq', help='--mapQ of the run [0]', type=int, default=0)
+    parser.add_argument('--id_cutoff', help='--id_cutoff of the run [0]', type=float, default=0)
+    parser.add_argument('--jobs', help='--jobs of the run [1]', type=int, default=1)
+    parser.add_argument('--samtools', help='read alignments with samtools view', action='store_true')
+    parser.add_argument('--format', help='--format of the run [tsv]', choices=['tsv', 'npz', 'mtx'], default='tsv')
+    parser.add_argument('--sparse', help='--sparse run', action='store_true')
+    parser.add_argument('--max_memory', help='--max_memory of the run', type=int)
+    parser.add_argument('--repeat', help='number of timed runs [3]', type=int, default=3)
+    parser.add_argument('--seed', help='random generator seed [0]', type=int, default=0)
+    parser.add_argument('--workdir', help='keep the synthetic inputs in this directory')
+    parser.add_argument('--output', help='JSON results file [stdout]')
+    parser.add_argument('--run_repeat', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_repeat:
+        spec = json.loads(args.run_repeat)
+        results = run(Namespace(**spec['args']), spec['inputs'], spec['output_dir'])
+        with open(spec['results'], 'w') as output_handle:
+            json.dump(results, output_handle)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bamtk_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        start = time.perf_counter()
+        inputs = generate(args, workdir)
+        generation = time.perf_counter() - start
+
+        runs = []
+        for i in range(args.repeat):
+            output_dir = os.path.join(workdir, 'run_%d' % (i + 1))
+            shutil.rmtree(output_dir, ignore_errors=True)
+            runs.append(run_repeat(args, inputs, output_dir))
+
+        results = {'bamtk_version': open(os.path.join(bamtk.__path__[0], 'VERSION')).readline().strip(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'run_repeat')},
+                   'input_bytes': sum(os.path.getsize(path) for path in inputs) +
+                                  sum(os.path.getsize(os.path.join(workdir, 'sample_%d.bam' % (i + 1)))
+                                      for i in range(args.samples)),
+                   'generation_seconds': generation,
+                   'runs': runs,
+                   'best': {'features_wall': min(r['features']['wall'] for r in runs),
+                            'annotated_features_wall': min(r['annotated_features']['wall'] for r in runs),
+                            'reads_per_second': max(r['reads_per_second'] or 0 for r in runs)}}
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as output_handle:
+            json.dump(results, output_handle, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import os
+
+from bamtk.__main__ import get_parser
+from bamtk.main import OptionsParser
+from bamtk.server import IndexCache
+
+
+def write(path, lines):
+    with open(path, 'w') as f:
+        f.write(''.join('\t'.join(map(str, line)) + '\n' for line in lines))
+    return str(path)
+
+
+def test_cached_index_warns_for_each_job(tmp_path, caplog):
+    features_dir = tmp_path / 'features'
+    features_dir.mkdir()
+    for name in ('reads_raw', 'reads_normalised', 'reads_relative', 'base_raw', 'base_normalised', 'base_relative'):
+        write(features_dir / ('features_%s_abundance.tsv' % name),
+              [('Features', 'Features_size', 'sample'), ('f1', 100, 1), ('f2', 100, 2), ('f3', 100, 3)])
+    features_annotation = write(tmp_path / 'features2annotation.tsv', [('f1', 'K1'), ('f2', 'K9')])
+    annotation_description = write(tmp_path / 'description.tsv', [('K1', 'first')])
+
+    args = get_parser().parse_args(['mm_annotated_features', str(features_dir), features_annotation,
+                                    annotation_description, '--silent'])
+    parser = OptionsParser(IndexCache())
+    for job in range(2):
+        caplog.clear()
+        parser.parse_options(args)
+        warnings = [record.getMessage() for record in caplog.records if record.levelname == 'WARNING']
+        assert warnings == ["'K9' not present in %s" % annotation_description, '1 features without annotation']
+    assert os.path.exists(features_dir / 'annotate_reads_raw_abundance.tsv')
+
+
+def test_rollup_levels(tmp_path, caplog):
+    features_dir = tmp_path / 'features'
+    features_dir.mkdir()
+    for name in ('reads_raw', 'reads_normalised', 'reads_relative', 'base_raw', 'base_normalised', 'base_relative'):
+        write(features_dir / ('features_%s_abundance.tsv' % name),
+              [('Features', 'Features_size', 'sample'), ('f1', 100, 1), ('f2', 100, 2), ('f3', 100, 4)])
+    features_annotation = write(tmp_path / 'features2annotation.tsv', [('f1', 'K1'), ('f2', 'K2'), ('f3', 'K2')])
+    annotation_description = write(tmp_path / 'description.tsv', [('K1', 'first'), ('K2', 'second')])
+    pathways = write(tmp_path / 'pathways.tsv', [('K1', 'P1'), ('K2', 'P1', 0.5), ('K2', 'P2', 0.5), ('K7', 'P3')])
+    classes = write(tmp_path / 'classes.tsv', [('P1', 'C1'), ('P2', 'C1')])
+
+    args = get_parser().parse_args(['mm_annotated_features', str(features_dir), features_annotation,
+                                    annotation_description, '--rollup', pathways, '--rollup', classes, '--silent'])
+    parser = OptionsParser(IndexCache())
+    for job in range(2):
+        caplog.clear()
+        parser.parse_options(args)
+        warnings = [record.getMessage() for record in caplog.records if record.levelname == 'WARNING']
+        assert '1 ids of %s not present in the previous level' % pathways in warnings
+
+    with open(features_dir / 'level2_annotate_reads_raw_abundance.tsv') as f:
+        assert f.read().splitlines()[1:] == ['P1\t4.0', 'P2\t3.0', 'P3\t0.0']
+    with open(features_dir / 'level3_annotate_reads_raw_abundance.tsv') as f:
+        assert f.read().splitlines()[1:] == ['C1\t7.0']
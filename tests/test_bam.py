@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from bamtk.bam import BamIndex, BamReader, count_alignments
+from bamtk.main import OptionsParser
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_bamtk
+
+
+def record_bounds(path):
+    """Uncompressed offsets of the BGZF block ends and of the record starts"""
+
+    reader = BamReader(path)
+    reader.bgzf.seek(0)
+    blocks = [data for coffset, data in reader.bgzf.blocks()]
+    reader.close()
+    data = b''.join(blocks)
+    offset = 8 + int.from_bytes(data[4:8], 'little')
+    n_ref = int.from_bytes(data[offset:offset + 4], 'little')
+    offset += 4
+    for _ in range(n_ref):
+        offset += 8 + int.from_bytes(data[offset:offset + 4], 'little')
+    starts = []
+    while offset < len(data):
+        starts.append(offset)
+        offset += 4 + int.from_bytes(data[offset:offset + 4], 'little')
+    return np.cumsum([len(block) for block in blocks]), np.array(starts)
+
+
+@pytest.fixture(scope='module')
+def indexed_bam(tmp_path_factory):
+    """Synthetic BAM whose records are split across BGZF blocks, with its BAI"""
+
+    pysam = pytest.importorskip('pysam')
+    workdir = tmp_path_factory.mktemp('bam')
+    rng = np.random.default_rng(0)
+    references = bench_bamtk.generate_faidx(str(workdir / 'catalogue.fa.fai'), 200, 300, 3000, rng)
+    path = str(workdir / 'sample.bam')
+    bench_bamtk.generate_bam(path, references, 20000, 'mixed', rng)
+    pysam.index(path)
+    return path
+
+
+def test_records_span_blocks(indexed_bam):
+    block_ends, starts = record_bounds(indexed_bam)
+    # a block ending inside a record
+    assert not np.isin(block_ends[:-1], starts).all()
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_regions_match_whole_file(indexed_bam, threads):
+    references, reads, bases = count_alignments(indexed_bam, threads=threads)
+    regions = BamIndex(indexed_bam + '.bai').regions(4)
+    assert len(regions) == 4
+
+    region_reads = np.zeros_like(reads)
+    region_bases = np.zeros_like(bases)
+    for region in regions:
+        part_references, part_reads, part_bases = count_alignments(indexed_bam, threads=threads, region=region)
+        assert part_references == references
+        region_reads += part_reads
+        region_bases += part_bases
+    assert (region_reads == reads).all()
+    assert (region_bases == bases).all()
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_targets_match_whole_file(indexed_bam, threads):
+    references, reads, bases = count_alignments(indexed_bam, threads=threads)
+    ref_ids = np.concatenate([np.arange(10, 20), np.arange(60, 200, 7)])
+    regions = BamIndex(indexed_bam + '.bai').targets(ref_ids)
+
+    region_reads = np.zeros_like(reads)
+    region_bases = np.zeros_like(bases)
+    for region in regions:
+        part_references, part_reads, part_bases = count_alignments(indexed_bam, threads=threads, region=region)
+        region_reads += part_reads
+        region_bases += part_bases
+    assert (region_reads[ref_ids] == reads[ref_ids]).all()
+    assert (region_bases[ref_ids] == bases[ref_ids]).all()
+    assert region_reads.sum() == reads[ref_ids].sum()
+
+
+def strip_pseudo_bins(path, output):
+    """Write a copy of a BAI index without the pseudo-bin of each reference"""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    parts = [data[:8]]
+    off = 8
+    for _ in range(int.from_bytes(data[4:8], 'little')):
+        n_bin = int.from_bytes(data[off:off + 4], 'little')
+        off += 4
+        bins = []
+        for _ in range(n_bin):
+            n_chunk = int.from_bytes(data[off + 4:off + 8], 'little')
+            size = 8 + 16 * n_chunk
+            if int.from_bytes(data[off:off + 4], 'little') != 37450:
+                bins.append(data[off:off + size])
+            off += size
+        n_intv = int.from_bytes(data[off:off + 4], 'little')
+        parts.append(len(bins).to_bytes(4, 'little') + b''.join(bins) + data[off:off + 4 + 8 * n_intv])
+        off += 4 + 8 * n_intv
+    parts.append(data[off:])
+    with open(output, 'wb') as f:
+        f.write(b''.join(parts))
+
+
+def test_fast_index_without_pseudo_bins(indexed_bam, tmp_path):
+    bam = str(tmp_path / 'sample.bam')
+    os.symlink(indexed_bam, bam)
+    strip_pseudo_bins(indexed_bam + '.bai', bam + '.bai')
+    index = BamIndex(bam + '.bai')
+    assert all(count is None for count, span in zip(index.mapped, index.spans) if span is not None)
+
+    counts = {}
+    for sample in (indexed_bam, bam):
+        counts[sample] = []
+        OptionsParser().index_samples([(sample, 1, 'sample')], lambda i, c: counts[sample].append(c[1]))
+    assert np.array_equal(counts[bam][0], counts[indexed_bam][0])
+    assert counts[bam][0].sum() > 0
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_toy_known_counts(threads):
+    # counts of the toy matrices of the samtools based reader
+    expected = {'sample_1': ([46, 4], [4288, 96]), 'sample_2': ([0, 16], [0, 1332])}
+    for sample, (reads, bases) in expected.items():
+        counts = count_alignments(os.path.join(DATA_DIR, sample + '.bam'), min_mapq=10, threads=threads)
+        assert counts[0] == ['Cluster_205', 'Cluster_497']
+        assert counts[1].tolist() == reads
+        assert counts[2].tolist() == bases
+
+
+@pytest.mark.parametrize('min_mapq, id_cutoff', [(0, 0), (10, 0.9)])
+def test_counts_match_pysam(indexed_bam, min_mapq, id_cutoff):
+    pysam = pytest.importorskip('pysam')
+    with pysam.AlignmentFile(indexed_bam) as input_handle:
+        reads = np.zeros(input_handle.nreferences, dtype=np.int64)
+        bases = np.zeros(input_handle.nreferences, dtype=np.int64)
+        for record in input_handle.fetch(until_eof=True):
+            if record.reference_id < 0 or record.mapping_quality < min_mapq:
+                continue
+            matched = sum(length for op, length in record.cigartuples if op == pysam.CMATCH)
+            read_len = record.query_length or record.infer_query_length()
+            if (matched / read_len if read_len else 0) < id_cutoff:
+                continue
+            reads[record.reference_id] += 1
+            bases[record.reference_id] += matched
+    assert reads.sum() > 0
+
+    references, native_reads, native_bases = count_alignments(indexed_bam, min_mapq, id_cutoff)
+    assert len(references) == len(reads)
+    assert np.array_equal(native_reads, reads)
+    assert np.array_equal(native_bases, bases)
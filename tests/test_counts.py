@@ -0,0 +1,225 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from bamtk import FeatureCounter
+from bamtk.__main__ import get_parser
+from bamtk.bam import count_alignments
+from bamtk.common import findEx
+from bamtk.main import OptionsParser
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_bamtk
+
+
+def matrices(output_dir):
+    """Content of the tabular matrices of an output directory"""
+
+    contents = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.tsv'):
+            with open(os.path.join(output_dir, name)) as f:
+                contents[name] = f.read()
+    return contents
+
+
+def mm_features(faidx, bam_list, output_dir, *options):
+    args = get_parser().parse_args(['mm_features', faidx, bam_list, str(output_dir), '-fx', 'fa.fai', '--silent']
+                                   + list(options))
+    OptionsParser().parse_options(args)
+    return matrices(output_dir)
+
+
+@pytest.fixture(scope='module')
+def toy(tmp_path_factory):
+    """faidx and bam_list of the tests/data samples"""
+
+    workdir = tmp_path_factory.mktemp('toy')
+    bam_list = str(workdir / 'bam_list.txt')
+    with open(bam_list, 'w') as f:
+        f.write('#bam_files\tlibrary_size\n')
+        f.write('%s\t50\n%s\t16\n' % (os.path.join(DATA_DIR, 'sample_1.bam'), os.path.join(DATA_DIR, 'sample_2.bam')))
+    return os.path.join(DATA_DIR, 'toy.fa.fai'), bam_list
+
+
+@pytest.fixture(scope='module')
+def synthetic(tmp_path_factory):
+    """faidx and bam_list of indexed synthetic samples with records spanning BGZF blocks"""
+
+    pysam = pytest.importorskip('pysam')
+    workdir = tmp_path_factory.mktemp('synthetic')
+    rng = np.random.default_rng(0)
+    faidx = str(workdir / 'catalogue.fa.fai')
+    references = bench_bamtk.generate_faidx(faidx, 300, 300, 3000, rng, contigs=2)
+    bam_list = str(workdir / 'bam_list.txt')
+    with open(bam_list, 'w') as f:
+        for i in range(2):
+            bam = str(workdir / ('sample_%d.bam' % (i + 1)))
+            bench_bamtk.generate_bam(bam, references, 20000, 'mixed', rng)
+            pysam.index(bam)
+            f.write('%s\t40000\n' % bam)
+    return faidx, bam_list
+
+
+@pytest.mark.parametrize('options', [['--jobs', '2'], ['--jobs', '2', '--threads', '1'], ['--max_memory', '1'],
+                                     ['--sparse']])
+def test_toy_parity(toy, tmp_path, options):
+    expected = mm_features(*toy, tmp_path / 'native')
+    assert expected['features_reads_raw_count.tsv'].count('\n') == 3
+    # empty cells of the raw abundances are written as integers
+    assert expected['features_reads_raw_abundance.tsv'].splitlines()[1].endswith('\t0')
+    assert mm_features(*toy, tmp_path / 'options', *options) == expected
+
+
+def test_toy_samtools(toy, tmp_path):
+    if findEx('samtools') is None:
+        pytest.skip('samtools is not on the system path')
+    assert mm_features(*toy, tmp_path / 'samtools', '--samtools') == mm_features(*toy, tmp_path / 'native')
+
+
+def test_toy_cache(toy, tmp_path):
+    expected = mm_features(*toy, tmp_path / 'native')
+    assert mm_features(*toy, tmp_path / 'cached', '--cache') == expected
+    # second run reads every sample from the cache
+    assert os.listdir(tmp_path / 'cached' / 'counts_cache')
+    assert mm_features(*toy, tmp_path / 'cached', '--cache') == expected
+
+
+def shard_stores(faidx, bam_list, output_dir, total, *options):
+    stores = []
+    for i in range(1, total + 1):
+        mm_features(faidx, bam_list, output_dir / ('shard_%d' % i), '--shard', '%d/%d' % (i, total), *options)
+        stores.append(str(output_dir / ('shard_%d' % i) / ('features_shard_%d_of_%d.npz' % (i, total))))
+    return stores
+
+
+def mm_merge(output_dir, *stores):
+    args = get_parser().parse_args(['mm_merge', str(output_dir)] + list(stores) + ['--silent'])
+    OptionsParser().parse_options(args)
+    return matrices(output_dir)
+
+
+def test_toy_shards(toy, tmp_path):
+    expected = mm_features(*toy, tmp_path / 'native')
+    stores = shard_stores(*toy, tmp_path, 2)
+    assert mm_merge(tmp_path / 'merged', *reversed(stores)) == expected
+
+    # the second shard run on another node, with other faidx and bam_list paths
+    node = tmp_path / 'node'
+    node.mkdir()
+    faidx, bam_list = str(node / 'toy.fa.fai'), str(node / 'bam_list.txt')
+    for source, copy in zip(toy, (faidx, bam_list)):
+        with open(source) as f, open(copy, 'w') as output_handle:
+            output_handle.write(f.read())
+    moved = shard_stores(faidx, bam_list, node, 2)
+    assert mm_merge(tmp_path / 'moved', stores[0], moved[1]) == expected
+
+
+def test_toy_shards_errors(toy, tmp_path, caplog):
+    stores = shard_stores(*toy, tmp_path, 2)
+    with pytest.raises(SystemExit):
+        mm_merge(tmp_path / 'missing', stores[0])
+    assert 'Missing shard(s) 2 of 2' in caplog.text
+    with pytest.raises(SystemExit):
+        mm_merge(tmp_path / 'twice', stores[0], stores[0], stores[1])
+    assert 'Shard 1/2 given twice' in caplog.text
+
+    mapq = shard_stores(*toy, tmp_path / 'mapq', 2, '--mapQ', '2')
+    with pytest.raises(SystemExit):
+        mm_merge(tmp_path / 'options', stores[0], mapq[1])
+    assert 'were not computed with the same options: mapQ' in caplog.text
+
+
+@pytest.mark.parametrize('add', ['counts', 'records'])
+def test_feature_counter(toy, tmp_path, add):
+    expected = mm_features(*toy, tmp_path / 'native')
+    counter = FeatureCounter(toy[0])
+    counter.add_sample(os.path.join(DATA_DIR, 'sample_1.bam'), library_size=50)
+    sample_2 = os.path.join(DATA_DIR, 'sample_2.bam')
+    if add == 'counts':
+        counter.add_counts('sample_2', *count_alignments(sample_2, min_mapq=10), library_size=16)
+    else:
+        pysam = pytest.importorskip('pysam')
+        with pysam.AlignmentFile(sample_2) as input_handle:
+            records = [(record.reference_name, record.mapping_quality, record.cigarstring, record.query_length)
+                       for record in input_handle]
+        counter.add_records('sample_2', records, library_size=16)
+
+    (tmp_path / 'counter').mkdir()
+    counter.matrices().write(str(tmp_path / 'counter'))
+    assert matrices(tmp_path / 'counter') == expected
+    arrays = counter.arrays()
+    assert arrays['features_reads_raw_count'].tolist() == [[46, 0], [4, 16]]
+
+
+def columns(matrix):
+    """Sample columns of a tabular matrix, by name"""
+
+    header, *rows = [line.split('\t') for line in matrix.splitlines()]
+    values = np.array([row[2:] for row in rows], dtype=float)
+    return {name: values[:, j] for j, name in enumerate(header[2:])}
+
+
+@pytest.fixture
+def read_groups(tmp_path):
+    """faidx and bam_list of two BAM files of RG:Z tagged records, a read group sample spanning both"""
+
+    pysam = pytest.importorskip('pysam')
+    faidx = str(tmp_path / 'toy.fa.fai')
+    with open(faidx, 'w') as f:
+        f.write('contig1\t1000\t0\t60\t61\ncontig2\t500\t0\t60\t61\n')
+    bam_list = str(tmp_path / 'bam_list.txt')
+    rng = np.random.default_rng(0)
+    with open(bam_list, 'w') as bam_list_handle:
+        for name, groups in (('run_1', [('a', 'lane_1'), ('b', 'lane_2')]), ('run_2', [('c', 'lane_1')])):
+            path = str(tmp_path / (name + '.bam'))
+            header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+                      'SQ': [{'SN': 'contig1', 'LN': 1000}, {'SN': 'contig2', 'LN': 500}],
+                      'RG': [{'ID': group, 'SM': sample} for group, sample in groups]}
+            with pysam.AlignmentFile(path, 'wb', header=header) as output_handle:
+                for i, reference in enumerate(sorted(rng.integers(0, 2, size=60).tolist())):
+                    record = pysam.AlignedSegment()
+                    record.query_name = 'r%d' % i
+                    record.reference_id = reference
+                    record.reference_start = i
+                    record.cigarstring = ['50M', '10S40M', '20M5I25M'][i % 3]
+                    record.query_sequence = 'A' * 50
+                    record.mapping_quality = 60
+                    record.set_tag('RG', groups[i % len(groups)][0], 'Z')
+                    output_handle.write(record)
+            bam_list_handle.write('%s\t100\n' % path)
+    return faidx, bam_list
+
+
+def test_read_groups_sum_to_samples(read_groups, tmp_path):
+    samples = mm_features(*read_groups, tmp_path / 'samples')
+    groups = mm_features(*read_groups, tmp_path / 'groups', '--by_read_group')
+    for name in ('features_reads_raw_count.tsv', 'features_base_raw_abundance.tsv'):
+        sample_columns = columns(samples[name])
+        group_columns = columns(groups[name])
+        assert sorted(sample_columns) == ['run_1', 'run_2']
+        assert sorted(group_columns) == ['lane_1', 'lane_2']
+        assert sum(sample_columns.values()).sum() > 0
+        assert np.allclose(sum(group_columns.values()), sum(sample_columns.values()))
+    # lane_1 is half of run_1 and the whole run_2
+    group_reads = columns(groups['features_reads_raw_count.tsv'])
+    assert (group_reads['lane_1'].sum(), group_reads['lane_2'].sum()) == (90, 30)
+
+
+@pytest.mark.parametrize('options', [['--jobs', '4'], ['--jobs', '3', '--merge'], ['--max_memory', '1', '--jobs', '2']])
+def test_indexed_regions_parity(synthetic, tmp_path, options):
+    merge = ['--merge'] if '--merge' in options else []
+    expected = mm_features(*synthetic, tmp_path / 'native', *merge)
+    assert mm_features(*synthetic, tmp_path / 'regions', *options) == expected
+
+
+def test_indexed_samtools(synthetic, tmp_path):
+    if findEx('samtools') is None:
+        pytest.skip('samtools is not on the system path')
+    expected = mm_features(*synthetic, tmp_path / 'native')
+    assert mm_features(*synthetic, tmp_path / 'samtools', '--samtools') == expected
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from bamtk.bam import count_alignments
+from bamtk.common import findEx
+from bamtk.coverage import Coverage
+
+
+def test_blocks_added_in_batches():
+    whole = Coverage(2, [100])
+    whole.add(0, [0, 10, 50, 95], [20, 30, 60, 120], [0, 1, 0, 1])
+    batches = Coverage(2, [100])
+    batches.add(0, [0, 10], [20, 30], [0, 1])
+    batches.add(0, [50, 95], [60, 120], [0, 1])
+    covered, depth = batches.arrays(None, 1)
+    assert (covered == whole.arrays(None, 1)[0]).all()
+    # blocks are clipped to the reference length
+    assert covered.tolist() == [[30, 25]]
+    assert depth.tolist() == [[30, 25]]
+
+
+def test_groups_covered_together():
+    coverage = Coverage(3, [100], groups=[0, 0, 2])
+    coverage.add(0, [0, 10, 0], [20, 30, 5], [0, 1, 2])
+    covered, depth = coverage.arrays(None, 1)
+    assert covered.tolist() == [[30, 0, 5]]
+    assert depth.tolist() == [[40, 0, 5]]
+
+
+def test_unsorted_references():
+    coverage = Coverage(1, [100, 100])
+    coverage.add(0, [0], [10])
+    coverage.add(1, [0], [10])
+    assert not coverage.unsorted
+    coverage.add(0, [50], [60])
+    assert coverage.unsorted
+    assert coverage.arrays(None, 2)[0].tolist() == [[20], [10]]
+
+
+@pytest.fixture
+def overhanging_bam(tmp_path):
+    """BAM with records aligned past the end of their reference"""
+
+    pysam = pytest.importorskip('pysam')
+    path = str(tmp_path / 'overhanging.bam')
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'contig1', 'LN': 100}, {'SN': 'contig2', 'LN': 50}]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as output_handle:
+        for i, (reference, position, cigar) in enumerate([(0, 0, '30M'), (0, 80, '10M5D20M'),
+                                                          (1, 10, '5S20M'), (1, 40, '30M')]):
+            record = pysam.AlignedSegment()
+            record.query_name = 'r%d' % i
+            record.reference_id = reference
+            record.reference_start = position
+            record.cigarstring = cigar
+            record.query_sequence = 'A' * record.infer_query_length()
+            record.mapping_quality = 60
+            output_handle.write(record)
+    return path
+
+
+def test_samtools_coverage_matches_native(overhanging_bam):
+    if findEx('samtools') is None:
+        pytest.skip('samtools is not on the system path')
+    native = count_alignments(overhanging_bam, coverage=True)
+    samtools = count_alignments(overhanging_bam, samtools=True, coverage=True)
+    assert samtools[0] == native[0]
+    for native_counts, samtools_counts in zip(native[1:], samtools[1:]):
+        assert np.array_equal(native_counts, samtools_counts)
+    covered, depth = native[3], native[4]
+    assert covered.tolist() == [45, 30]
+    assert depth.tolist() == [45, 30]
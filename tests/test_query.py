@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+from bamtk.__main__ import get_parser
+from bamtk.main import OptionsParser
+from bamtk.matrix import ROW_INDEX_SUFFIX, MatrixWriter, RowIndex
+
+
+@pytest.fixture
+def matrix(tmp_path):
+    """Tabular matrix written in blocks of a few rows, with its row index"""
+
+    path = str(tmp_path / 'features_reads_raw_count.tsv')
+    features = ['f%d' % i for i in range(50)]
+    values = np.arange(150).reshape(50, 3)
+    writer = MatrixWriter(path, ['Features', 'Features_size', 's1', 's2', 's3'], features,
+                          np.arange(100, 150), block_rows=7)
+    writer.write(np.arange(50), values)
+    writer.close()
+    return path
+
+
+def query(matrix, output, *options):
+    args = get_parser().parse_args(['query', matrix, '-o', str(output)] + list(options))
+    OptionsParser().parse_options(args)
+    with open(output) as f:
+        return f.read().splitlines()
+
+
+def test_row_index_lookup(matrix):
+    index = RowIndex.load(matrix + ROW_INDEX_SUFFIX)
+    assert index.matrix_stamp == RowIndex.stamp(matrix)
+    offsets = index.lookup(['f31', 'f0', 'g1'])
+    assert offsets[2] == -1
+    with open(matrix) as f:
+        for name, offset in zip(['f31', 'f0'], offsets.tolist()):
+            f.seek(offset)
+            assert f.readline().startswith(name + '\t')
+
+
+def test_query_rows_and_samples(matrix, tmp_path, caplog):
+    lines = query(matrix, tmp_path / 'rows.tsv', '-r', 'f42', 'g1', 'f7', '-s', 's3', 'x', 's1')
+    assert lines == ['Features\tFeatures_size\ts3\ts1', 'f42\t142\t128\t126', 'f7\t107\t23\t21']
+    assert 'No up to date row index' not in caplog.text
+    assert '1 rows not found in %s: g1' % matrix in caplog.text
+    assert '1 samples not found in %s: x' % matrix in caplog.text
+
+
+def test_query_stale_index(matrix, tmp_path, caplog):
+    # same size, other rows order and modification time
+    with open(matrix) as f:
+        header, *rows = f.readlines()
+    with open(matrix, 'w') as f:
+        f.write(header + ''.join(reversed(rows)))
+    stamp = RowIndex.stamp(matrix)
+    os.utime(matrix, ns=(stamp[1] + 10 ** 9, stamp[1] + 10 ** 9))
+    assert RowIndex.load(matrix + ROW_INDEX_SUFFIX).matrix_stamp[0] == os.path.getsize(matrix)
+
+    lines = query(matrix, tmp_path / 'rows.tsv', '-r', 'f42', 'f7', '-s', 's2')
+    assert lines == ['Features\tFeatures_size\ts2', 'f42\t142\t127', 'f7\t107\t22']
+    assert 'No up to date row index for %s, scanning the matrix' % matrix in caplog.text